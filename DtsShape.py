@@ -147,6 +147,9 @@ class DtsInputStream(object):
 		self.tell8 += 1
 		return data
 
+	def read_u8(self):
+		return self.read8() & 0xFF
+
 	def read_float(self):
 		return unpack("f", pack("i", self.read32()))[0]
 
@@ -565,6 +568,11 @@ class DtsShape(object):
 		self.meshes = [Mesh.read(stream) for i in range(n_mesh)]
 		stream.guard()
 
+		# A parent always comes before the meshes sharing its geometry
+		for mesh in self.meshes:
+			if mesh.get_type() != Mesh.NullType and mesh.parent >= 0:
+				mesh.share_geometry(self.meshes[mesh.parent])
+
 		# Names
 		self.names = [None] * n_name
 		self._names_lookup = {}
@@ -266,20 +266,25 @@ class Mesh:
                 stream.write_vec3(self.center)
                 stream.write_float(self.radius)
 
-                # Geometry data
+                # Geometry data, taken from the parent mesh when there is one
+                shared = self.parent >= 0
+
                 stream.write32(len(self.verts))
-                for vert in self.verts:
-                        stream.write_vec3(vert)
+                if not shared:
+                        for vert in self.verts:
+                                stream.write_vec3(vert)
                 stream.write32(len(self.tverts))
-                for tvert in self.tverts:
-                        stream.write_vec2(tvert)
+                if not shared:
+                        for tvert in self.tverts:
+                                stream.write_vec2(tvert)
 
                 assert len(self.normals) == len(self.verts)
                 assert len(self.enormals) == len(self.verts)
-                for normal in self.normals:
-                        stream.write_vec3(normal)
-                for enormal in self.enormals:
-                        stream.write8(enormal)
+                if not shared:
+                        for normal in self.normals:
+                                stream.write_vec3(normal)
+                        for enormal in self.enormals:
+                                stream.write_u8(enormal)
 
                 # Primitives and other stuff
                 stream.write32(len(self.primitives))
@@ -296,29 +301,35 @@ class Mesh:
                 stream.guard()
 
                 if mtype == Mesh.SkinType:
+                    # Skin data is shared with the parent mesh as well
                     stream.write32(len(self.verts))
-                    for v in self.verts:
-                        stream.write_vec3(v)
-                    for v in self.normals:
-                        stream.write_vec3(v)
-                    stream.write8(*self.enormals)
+                    if not shared:
+                        for v in self.verts:
+                            stream.write_vec3(v)
+                        for v in self.normals:
+                            stream.write_vec3(v)
+                        for enormal in self.enormals:
+                            stream.write_u8(enormal)
 
                     stream.write32(len(self.bones))
-                    for _, initial_transform in self.bones:
-                        for f in initial_transform:
-                            stream.write_float(f)
+                    if not shared:
+                        for _, initial_transform in self.bones:
+                            for f in initial_transform:
+                                stream.write_float(f)
 
                     stream.write32(len(self.influences))
-                    for vertex_index, _, _ in self.influences:
-                        stream.write32(vertex_index)
-                    for _, bone_index, _ in self.influences:
-                        stream.write32(bone_index)
-                    for _, _, weight in self.influences:
-                        stream.write_float(weight)
+                    if not shared:
+                        for vertex_index, _, _ in self.influences:
+                            stream.write32(vertex_index)
+                        for _, bone_index, _ in self.influences:
+                            stream.write32(bone_index)
+                        for _, _, weight in self.influences:
+                            stream.write_float(weight)
 
                     stream.write32(len(self.bones))
-                    for node_index, _ in self.bones:
-                        stream.write32(node_index)
+                    if not shared:
+                        for node_index, _ in self.bones:
+                            stream.write32(node_index)
 
                     stream.guard()
                 elif mtype != Mesh.StandardType:
@@ -334,14 +345,18 @@ class Mesh:
                 self.center = stream.read_vec3()
                 self.radius = stream.read_float()
 
-                # Geometry data
+                # Geometry data, left for share_geometry when there is a parent
+                shared = self.parent >= 0
+
                 n_vert = stream.read32()
-                self.verts = [stream.read_vec3() for i in range(n_vert)]
+                if not shared:
+                        self.verts = [stream.read_vec3() for i in range(n_vert)]
                 n_tvert = stream.read32()
-                self.tverts = [stream.read_vec2() for i in range(n_tvert)]
-                self.normals = [stream.read_vec3() for i in range(n_vert)]
-                # TODO: don't read this when not relevant
-                self.enormals = [stream.read8() for i in range(n_vert)]
+                if not shared:
+                        self.tverts = [stream.read_vec2() for i in range(n_tvert)]
+                        self.normals = [stream.read_vec3() for i in range(n_vert)]
+                        # TODO: don't read this when not relevant
+                        self.enormals = [stream.read_u8() for i in range(n_vert)]
 
                 # Primitives and other stuff
                 self.primitives = [Primitive.read(stream) for i in range(stream.read32())]
@@ -354,37 +369,51 @@ class Mesh:
 
         def read_skin_mesh(self, stream):
                 self.read_standard_mesh(stream)
+                shared = self.parent >= 0
 
                 sz = stream.read32()
-                _ = [stream.read_vec3() for i in range(sz)]
-                _ = [stream.read_vec3() for i in range(sz)]
-                _ = [stream.read8() for i in range(sz)]
+                if not shared:
+                    _ = [stream.read_vec3() for i in range(sz)]
+                    _ = [stream.read_vec3() for i in range(sz)]
+                    _ = [stream.read8() for i in range(sz)]
 
-                sz = stream.read32()
-                self.bones = [[None, None] for i in range(sz)]
+                n_bone = stream.read32()
+                if not shared:
+                    self.bones = [[None, None] for i in range(n_bone)]
 
-                for i in range(sz):
-                    initial_transform = [stream.read_float() for i in range(16)]
-                    self.bones[i][1] = initial_transform
+                    for i in range(n_bone):
+                        initial_transform = [stream.read_float() for i in range(16)]
+                        self.bones[i][1] = initial_transform
 
                 sz = stream.read32()
-                self.influences = [[None, None, None] for i in range(sz)]
+                if not shared:
+                    self.influences = [[None, None, None] for i in range(sz)]
 
-                for i in range(sz):
-                    self.influences[i][0] = stream.read32()
-                for i in range(sz):
-                    self.influences[i][1] = stream.read32()
-                for i in range(sz):
-                    self.influences[i][2] = stream.read_float()
+                    for i in range(sz):
+                        self.influences[i][0] = stream.read32()
+                    for i in range(sz):
+                        self.influences[i][1] = stream.read32()
+                    for i in range(sz):
+                        self.influences[i][2] = stream.read_float()
 
                 sz = stream.read32()
-                assert sz == len(self.bones)
+                assert sz == n_bone
 
-                for i in range(sz):
-                    self.bones[i][0] = stream.read32()
+                if not shared:
+                    for i in range(sz):
+                        self.bones[i][0] = stream.read32()
 
                 stream.guard()
 
+        def share_geometry(self, parent):
+                """Take the vertex and skin data of a mesh read with this one as its parent"""
+                self.verts = parent.verts
+                self.tverts = parent.tverts
+                self.normals = parent.normals
+                self.enormals = parent.enormals
+                self.bones = parent.bones
+                self.influences = parent.influences
+
         @classmethod
         def read(cls, stream):
                 mtype = stream.read32() & Mesh.TypeMask
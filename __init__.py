@@ -74,6 +74,13 @@ class ImportDTS(bpy.types.Operator, ImportHelper):
         default=False,
         )
 
+    normal_table = StringProperty(
+        name="Normal table",
+        description="Text file with the engine's 256 encoded normal directions, to decode normals with (optional)",
+        subtype='FILE_PATH',
+        default="",
+        )
+
     debug_report = BoolProperty(
         name="Write debug report",
         description="Dump out all the information from the DTS to a file",
@@ -160,6 +167,103 @@ class ExportDTS(bpy.types.Operator, ExportHelper):
         default=True,
         )
 
+    weld_vertices = BoolProperty(
+        name="Weld vertices",
+        description="Share vertices between faces where position, normal and UV match",
+        default=True,
+        )
+
+    use_strips = BoolProperty(
+        name="Triangle strips",
+        description="Write triangle strips instead of lists where they use fewer indices",
+        default=False,
+        )
+
+    optimize_cache = BoolProperty(
+        name="Optimize vertex cache",
+        description="Reorder triangles and vertices for the GPU vertex cache (slower export)",
+        default=False,
+        )
+
+    worker_count = IntProperty(
+        name="Worker processes (experimental)",
+        description="Experimental, Linux only: fork this many processes to build meshes in parallel (0 for one per CPU, 1 to build in Blender itself)",
+        default=1,
+        min=0,
+        )
+
+    use_mesh_cache = BoolProperty(
+        name="Cache meshes",
+        description="Reuse meshes from earlier exports when their data and settings did not change",
+        default=False,
+        )
+
+    mesh_cache_size = IntProperty(
+        name="Mesh cache size (MB)",
+        description="Remove the least recently used cached meshes above this size",
+        default=256,
+        min=1,
+        )
+
+    max_influences = IntProperty(
+        name="Max bone influences",
+        description="Keep only the strongest bone weights of each skinned vertex (0 for no limit)",
+        default=0,
+        min=0,
+        )
+
+    sort_translucent = BoolProperty(
+        name="Sort translucent triangles",
+        description="Order the triangles of translucent materials so inner surfaces are drawn before the outer shell",
+        default=True,
+        )
+
+    bone_palette_size = IntProperty(
+        name="Bone palette size",
+        description="Split skinned meshes into pieces that each use at most this many bones (0 for no limit)",
+        default=0,
+        min=0,
+        )
+
+    generate_lods = BoolProperty(
+        name="Generate detail levels",
+        description="Create lower detail levels by simplifying the meshes of the only detail level",
+        default=False,
+        )
+
+    lod_targets = StringProperty(
+        name="Detail level targets",
+        description="Comma separated triangle ratios (up to 1) or triangle budgets for each generated level, which halve in size",
+        default="0.5, 0.25, 0.125",
+        )
+
+    normal_table = StringProperty(
+        name="Normal table",
+        description="Text file with the engine's 256 encoded normal directions, as in its source (leave empty to not encode normals)",
+        subtype='FILE_PATH',
+        default="",
+        )
+
+    normal_tolerance = FloatProperty(
+        name="Encoded normal tolerance",
+        description="Largest angle in degrees between a normal and its table entry for a mesh to use encoded normals",
+        default=10.0,
+        min=0.0,
+        max=180.0,
+        )
+
+    share_geometry = BoolProperty(
+        name="Share mesh geometry",
+        description="Write identical vertex data only once and let later meshes reference it",
+        default=True,
+        )
+
+    write_profile = BoolProperty(
+        name="Write export profile",
+        description="Write the time taken by each export stage, object and sequence to a JSON file",
+        default=False,
+        )
+
     debug_report = BoolProperty(
         name="Write debug report",
         description="Dump out all the information from the DTS to a file",
@@ -225,57 +329,106 @@ class SplitMeshIndex(bpy.types.Operator):
 
         me = ob.data
 
-        out_me = None
-        out_ob = None
+        # Read everything in bulk up front
+        poly_count = len(me.polygons)
+        loop_starts = [0] * poly_count
+        loop_totals = [0] * poly_count
+        material_indices = [0] * poly_count
+        use_smooth = [False] * poly_count
+        me.polygons.foreach_get("loop_start", loop_starts)
+        me.polygons.foreach_get("loop_total", loop_totals)
+        me.polygons.foreach_get("material_index", material_indices)
+        me.polygons.foreach_get("use_smooth", use_smooth)
+
+        loop_vertices = [0] * len(me.loops)
+        me.loops.foreach_get("vertex_index", loop_vertices)
+
+        coords = [0.0] * (len(me.vertices) * 3)
+        normals = [0.0] * (len(me.vertices) * 3)
+        me.vertices.foreach_get("co", coords)
+        me.vertices.foreach_get("normal", normals)
+
+        uv_layers = []
+        for layer in me.uv_layers:
+            uvs = [0.0] * (len(me.loops) * 2)
+            layer.data.foreach_get("uv", uvs)
+            uv_layers.append((layer.name, uvs))
+
+        vertex_weights = [[(group.group, group.weight) for group in vert.groups]
+                          for vert in me.vertices]
+
+        # Partition the polygons before creating anything
+        pieces = [[]]
+        piece_loops = 0
+
+        for poly_index, loop_total in enumerate(loop_totals):
+            if loop_total >= limit:
+                continue
+
+            if piece_loops + loop_total > limit:
+                pieces.append([])
+                piece_loops = 0
+
+            pieces[-1].append(poly_index)
+            piece_loops += loop_total
 
-        def split():
-            nonlocal out_me
-            nonlocal out_ob
+        for polys in pieces:
+            loops = [loop for poly_index in polys
+                     for loop in range(loop_starts[poly_index],
+                                       loop_starts[poly_index] + loop_totals[poly_index])]
 
-            if out_me is not None:
-                out_me.validate()
-                out_me.update()
+            # Only keep the vertices this piece uses
+            remap = {}
+            for loop in loops:
+                remap.setdefault(loop_vertices[loop], len(remap))
+            verts = sorted(remap, key=remap.get)
 
             out_me = bpy.data.meshes.new(ob.name)
             out_ob = bpy.data.objects.new(ob.name, out_me)
 
             context.scene.objects.link(out_ob)
 
-            # For now, copy all verts over. See what happens?
-            out_me.vertices.add(len(me.vertices))
+            out_me.vertices.add(len(verts))
+            out_me.vertices.foreach_set("co", [coords[i * 3 + j] for i in verts for j in range(3)])
+            out_me.vertices.foreach_set("normal", [normals[i * 3 + j] for i in verts for j in range(3)])
 
-            for vert, out_vert in zip(me.vertices, out_me.vertices):
-                out_vert.co = vert.co
-                out_vert.normal = vert.normal
+            out_me.loops.add(len(loops))
+            out_me.loops.foreach_set("vertex_index", [remap[loop_vertices[loop]] for loop in loops])
 
-        split()
-
-        for poly in me.polygons:
-            if poly.loop_total >= limit:
-                continue
+            out_loop_starts = []
+            out_loop_total = 0
+            for poly_index in polys:
+                out_loop_starts.append(out_loop_total)
+                out_loop_total += loop_totals[poly_index]
 
-            if len(out_me.loops) + poly.loop_total > limit:
-                split()
+            out_me.polygons.add(len(polys))
+            out_me.polygons.foreach_set("loop_start", out_loop_starts)
+            out_me.polygons.foreach_set("loop_total", [loop_totals[i] for i in polys])
+            out_me.polygons.foreach_set("material_index", [material_indices[i] for i in polys])
+            out_me.polygons.foreach_set("use_smooth", [use_smooth[i] for i in polys])
 
-            loop_start = len(out_me.loops)
-            out_me.loops.add(poly.loop_total)
+            for material in me.materials:
+                out_me.materials.append(material)
 
-            out_me.polygons.add(1)
-            out_poly = out_me.polygons[-1]
+            for name, uvs in uv_layers:
+                out_me.uv_textures.new(name)
+                out_me.uv_layers[name].data.foreach_set("uv",
+                    [uvs[loop * 2 + j] for loop in loops for j in range(2)])
 
-            out_poly.loop_start = loop_start
-            out_poly.loop_total = poly.loop_total
-            out_poly.use_smooth = poly.use_smooth
+            # Vertex groups have no bulk access, so add them per distinct weight
+            for vertex_group in ob.vertex_groups:
+                out_ob.vertex_groups.new(vertex_group.name)
 
-            for loop_index, out_loop_index in zip(poly.loop_indices, out_poly.loop_indices):
-                loop = me.loops[loop_index]
-                out_loop = out_me.loops[out_loop_index]
+            weight_batches = {}
+            for vert in verts:
+                for group, weight in vertex_weights[vert]:
+                    weight_batches.setdefault((group, weight), []).append(remap[vert])
 
-                out_loop.normal = loop.normal
-                out_loop.vertex_index = loop.vertex_index
+            for (group, weight), batch in weight_batches.items():
+                out_ob.vertex_groups[group].add(batch, weight, "REPLACE")
 
-        out_me.validate()
-        out_me.update()
+            out_me.validate()
+            out_me.update()
 
         return {"FINISHED"}
 
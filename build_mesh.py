@@ -0,0 +1,272 @@
+import os
+import sys
+import multiprocessing
+from math import sqrt
+from functools import partial
+
+from .DtsTypes import Mesh, Primitive, Box, Vector
+from .optimize import VertexWelder, stripify, optimize_vertex_cache, \
+    cache_misses, reorder_vertices, split_mesh, split_bone_palettes, sort_translucent
+from .simplify import simplify_groups
+
+# Everything in this module below MeshData works on plain Python data, so
+# meshes can be built in worker processes. Blender types must not get in here.
+
+class MeshData:
+    """Snapshot of an evaluated Blender mesh, taken before building a DTS mesh"""
+
+    def __init__(self, name, mesh_type, transform):
+        self.name = name
+        self.mesh_type = mesh_type
+        self.transform = transform
+
+        # (primitive flags, corners) with corners as (co, normal, uv, vertex)
+        self.groups = []
+
+        # [(node index, weight)] for every Blender vertex
+        self.influences = []
+        # Node index -> flattened initial transform
+        self.bone_matrices = {}
+
+        # Triangle ratio or budget for generated detail levels
+        self.simplify = None
+
+        # Material indices whose triangles are ordered for translucency
+        self.sorted_materials = ()
+
+def transform_point(mat, co):
+    return tuple(row[0] * co[0] + row[1] * co[1] + row[2] * co[2] + row[3]
+                 for row in mat[:3])
+
+def transform_normal(mat, normal):
+    x, y, z = (row[0] * normal[0] + row[1] * normal[1] + row[2] * normal[2]
+               for row in mat[:3])
+    length = sqrt(x * x + y * y + z * z)
+
+    if length == 0:
+        return (x, y, z)
+
+    return (x / length, y / length, z / length)
+
+def get_bone_slot(mesh, bone_slots, node_index, bone_matrices):
+    slot = bone_slots.get(node_index)
+
+    if slot is None:
+        slot = bone_slots[node_index] = len(mesh.bones)
+        mesh.bones.append((node_index, bone_matrices[node_index]))
+
+    return slot
+
+def calculate_bounds(verts):
+    low = [10e30, 10e30, 10e30]
+    high = [-10e30, -10e30, -10e30]
+
+    for vert in verts:
+        for axis in range(3):
+            low[axis] = min(low[axis], vert[axis])
+            high[axis] = max(high[axis], vert[axis])
+
+    return tuple(low), tuple(high)
+
+def calculate_radius(verts, center):
+    radius = 0.0
+
+    for vert in verts:
+        radius = max(radius, sqrt(sum((vert[axis] - center[axis]) ** 2 for axis in range(3))))
+
+    return radius
+
+def finish_mesh(dmesh, use_strips, optimize_cache, sorted_materials=()):
+    indices = []
+    primitives = []
+
+    misses_before = 0
+    misses_after = 0
+    triangles = 0
+
+    low, high = calculate_bounds(dmesh.verts)
+    center = tuple((low[axis] + high[axis]) / 2 for axis in range(3))
+
+    for prim in dmesh.primitives:
+        elements = dmesh.indices[prim.firstElement:prim.firstElement + prim.numElements]
+        flags = prim.type
+
+        # Translucent primitives are drawn cluster by cluster, so the cache
+        # optimizer only reorders within clusters and strips are not used
+        sort = not flags & Primitive.NoMaterial and \
+            (flags & Primitive.MaterialMask) in sorted_materials
+
+        if sort:
+            clusters = sort_translucent(dmesh.verts, elements, center)
+        else:
+            clusters = [elements]
+
+        if optimize_cache:
+            optimized = [index for cluster in clusters for index in optimize_vertex_cache(cluster)]
+
+            misses_before += cache_misses(elements)
+            misses_after += cache_misses(optimized)
+            triangles += len(elements) // 3
+
+            elements = optimized
+        elif sort:
+            elements = [index for cluster in clusters for index in cluster]
+
+        # Only use a strip when it ends up smaller than the list
+        if use_strips and not sort:
+            strip = stripify(elements)
+
+            if len(strip) < len(elements):
+                elements = strip
+                flags |= Primitive.Strip
+
+        primitives.append(Primitive(len(indices), len(elements), flags))
+        indices.extend(elements)
+
+    dmesh.indices = indices
+    dmesh.primitives = primitives
+
+    if optimize_cache:
+        reorder_vertices(dmesh)
+
+        triangles = max(1, triangles)
+        dmesh.acmr = (misses_before / triangles, misses_after / triangles)
+
+    dmesh.bounds = calculate_bounds(dmesh.verts)
+    dmesh.center = (0.0, 0.0, 0.0)
+    dmesh.radius = calculate_radius(dmesh.verts, dmesh.center)
+
+def build_mesh(data, weld_vertices=True, use_strips=False, optimize_cache=False, palette_size=0):
+    """Build the finished DTS mesh pieces for a MeshData snapshot"""
+    dmesh = Mesh(data.mesh_type)
+    bone_slots = {}
+
+    if weld_vertices:
+        welder = VertexWelder()
+    else:
+        welder = None
+
+    if data.simplify is not None:
+        groups = simplify_groups(data.groups, data.simplify)
+    else:
+        groups = data.groups
+
+    # Create a primitive from each group
+    for flags, corners in groups:
+        firstElement = len(dmesh.indices)
+
+        for co, normal, uv, vert_index in corners:
+            co = transform_point(data.transform, co)
+            normal = transform_normal(data.transform, normal)
+
+            # Skin vertices also have to agree on their weights
+            if data.mesh_type == Mesh.SkinType:
+                source = vert_index
+            else:
+                source = None
+
+            if welder is not None:
+                vertex_index = welder.find(co, normal, uv, source)
+            else:
+                vertex_index = None
+
+            if vertex_index is None:
+                vertex_index = len(dmesh.verts)
+
+                dmesh.verts.append(co)
+                dmesh.normals.append(normal)
+                dmesh.enormals.append(0)
+                dmesh.tverts.append(uv)
+
+                if welder is not None:
+                    welder.add(vertex_index, co, normal, uv, source)
+
+                if data.mesh_type == Mesh.SkinType:
+                    for node_index, weight in data.influences[vert_index]:
+                        dmesh.influences.append((
+                            vertex_index,
+                            get_bone_slot(dmesh, bone_slots, node_index, data.bone_matrices),
+                            weight))
+
+            dmesh.indices.append(vertex_index)
+
+        numElements = len(dmesh.indices) - firstElement
+        dmesh.primitives.append(Primitive(firstElement, numElements, flags))
+
+    # ??? ? ?? ???? ??? ?
+    dmesh.vertsPerFrame = len(dmesh.verts)
+
+    # Skinning on the GPU can only use a limited number of bones per mesh
+    if data.mesh_type == Mesh.SkinType and palette_size:
+        pieces = split_bone_palettes(dmesh, palette_size)
+    else:
+        pieces = [dmesh]
+
+    # Indices are 16-bit, so break up meshes that cannot be referenced
+    # with them into several pieces
+    chunks = [chunk for piece in pieces for chunk in split_mesh(piece)]
+
+    for chunk in chunks:
+        finish_mesh(chunk, use_strips, optimize_cache, data.sorted_materials)
+
+    return chunks
+
+def restore_mesh(dmesh):
+    # Turn the plain tuples from build_mesh back into mathutils types
+    dmesh.verts = [Vector(vert) for vert in dmesh.verts]
+    dmesh.normals = [Vector(normal) for normal in dmesh.normals]
+    dmesh.tverts = [Vector(tvert) for tvert in dmesh.tverts]
+    dmesh.bounds = Box(Vector(dmesh.bounds[0]), Vector(dmesh.bounds[1]))
+    dmesh.center = Vector(dmesh.center)
+
+def build_meshes(jobs, workers=1, cache=None, **options):
+    """Run build_mesh for every MeshData, in worker processes when possible"""
+    results = [None] * len(jobs)
+    keys = [None] * len(jobs)
+
+    if cache is not None:
+        for index, data in enumerate(jobs):
+            keys[index] = cache.key(data, options)
+            results[index] = cache.get(keys[index])
+
+    pending = [index for index, chunks in enumerate(results) if chunks is None]
+
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+
+    workers = min(workers, len(pending))
+    context = None
+
+    # Workers are forked so they inherit the already imported add-on. Forking
+    # a multithreaded Blender is not safe anywhere, so this is experimental
+    # and limited to Linux, where it usually works. Windows cannot fork and
+    # macOS frameworks break after it, so there everything is built here.
+    if workers > 1 and sys.platform.startswith("linux"):
+        try:
+            context = multiprocessing.get_context("fork")
+        except ValueError:
+            pass
+
+    build = partial(build_mesh, **options)
+    pending_jobs = [jobs[index] for index in pending]
+
+    if context is None:
+        built = list(map(build, pending_jobs))
+    else:
+        with context.Pool(workers) as pool:
+            built = pool.map(build, pending_jobs)
+
+    for index, chunks in zip(pending, built):
+        results[index] = chunks
+
+        if cache is not None:
+            cache.put(keys[index], chunks)
+
+    if cache is not None:
+        cache.evict()
+
+    for chunks in results:
+        for chunk in chunks:
+            restore_mesh(chunk)
+
+    return results
@@ -5,9 +5,10 @@ from itertools import groupby
 
 from .DsqFile import DsqFile
 from .DtsTypes import *
-from .util import fail, evaluate_all, find_reference, array_from_fcurves, \
-    array_from_fcurves_rotation, fcurves_keyframe_in_range, find_reference
-from .shared_export import find_seqs
+from .util import fail, find_reference, FCurveIndex
+from .shared_export import find_seqs, check_seqs, sample_poses, drop_constant_tracks
+from .scene_snapshot import SceneSnapshot
+from .pose_store import blend_track
 
 def save(operator, context, filepath,
          select_marker=False,
@@ -31,18 +32,20 @@ def save(operator, context, filepath,
     node_ob = {}
     node_transform = {}
 
-    def traverse_node(node):
-        node_ob[node.name] = node
-        node_transform[node] = node.matrix_local.decompose()
-        dsq.nodes.append(node.name)
+    snapshot = SceneSnapshot(scene)
 
-        for child in node.children:
+    def traverse_node(info):
+        node_ob[info.name] = info.ob
+        node_transform[info.ob] = info.ob.matrix_local.decompose()
+        dsq.nodes.append(info.name)
+
+        for child in map(snapshot.get, info.children):
             if child.type == "EMPTY":
                 traverse_node(child)
 
-    for ob in scene.objects:
-        if ob.type == "EMPTY" and not ob.parent:
-            traverse_node(ob)
+    for info in snapshot.roots():
+        if info.type == "EMPTY":
+            traverse_node(info)
 
     reference_frame = find_reference(context.scene)
 
@@ -55,8 +58,15 @@ def save(operator, context, filepath,
         order_key = {}
 
     # Sort by node indices from the DTS
-    dsq.nodes.sort(key=lambda n:
-        order_key.get(n, node_ob[n].get("nodeIndex", sys.maxsize)))
+    def node_order(name):
+        node_index = snapshot.get(node_ob[name]).node_index
+
+        if node_index is None:
+            node_index = sys.maxsize
+
+        return order_key.get(name, node_index)
+
+    dsq.nodes.sort(key=node_order)
 
     node_index = {node_ob[name]: i for i, name in enumerate(dsq.nodes)}
     auto_root_index = None
@@ -64,30 +74,32 @@ def save(operator, context, filepath,
 
     for node in dsq.nodes:
         ob = node_ob[node]
-        data = ob.animation_data
-        if data and data.action and len(data.action.fcurves):
+        if snapshot.get(ob).animated:
             animated_nodes.append(ob)
 
-    for bobj in scene.objects:
-        if bobj.type != "MESH" or bobj.name.lower() == "bounds":
+    for info in snapshot.of_type("MESH"):
+        if info.name.lower() == "bounds":
             continue
 
-        if bobj.users_group and bobj.users_group[0].name == "__ignore__":
+        if info.groups and info.groups[0] == "__ignore__":
             continue
 
-        if not bobj.parent:
+        if not info.parent:
             if auto_root_index is None:
                 auto_root_index = len(dsq.nodes)
                 dsq.nodes.append("__auto_root__")
 
-    for name, markers in sequences.items():
-        print("Exporting sequence", name)
+    error = check_seqs(sequences)
 
-        if "start" not in markers:
-            return fail(operator, "Missing start marker for sequence '{}'".format(name))
+    if error is not None:
+        return fail(operator, error)
 
-        if "end" not in markers:
-            return fail(operator, "Missing end marker for sequence '{}'".format(name))
+    fcurve_index = FCurveIndex()
+    animation_data = sample_poses(scene, [(ob, ob) for ob in animated_nodes],
+                                  sequences, fcurve_index)
+
+    for name, markers in sequences.items():
+        print("Exporting sequence", name)
 
         frame_start = markers["start"].frame
         frame_end = markers["end"].frame
@@ -137,55 +149,61 @@ def save(operator, context, filepath,
 
         dsq.sequences.append(seq)
 
-        frame_indices = list(range(frame_start, frame_end + 1))
-
-        # Store all animation data so we don't need to frame_set all over the place
-        animation_data = {frame: {} for frame in frame_indices}
-
-        for frame in frame_indices:
-            scene.frame_set(frame)
-
-            for ob in animated_nodes:
-                animation_data[frame][ob] = ob.matrix_local.decompose()
+        dropped_tracks = []
 
         for ob in animated_nodes:
             index = node_index[ob]
 
-            base_translation, base_rotation, base_scale = node_transform[ob]
+            base_translation, base_rotation, _ = map(tuple, node_transform[ob])
 
-            fcurves = ob.animation_data.action.fcurves
+            action = ob.animation_data.action
 
-            curves_rotation = array_from_fcurves_rotation(fcurves, ob)
-            curves_translation = array_from_fcurves(fcurves, "location", 3)
-            curves_scale = array_from_fcurves(fcurves, "scale", 3)
+            curves_rotation = fcurve_index.rotation_curves(action, ob)
+            curves_translation = fcurve_index.curves(action, "location", 3)
+            curves_scale = fcurve_index.curves(action, "scale", 3)
 
             # Decide what matters by presence of f-curves
-            if curves_rotation and fcurves_keyframe_in_range(curves_rotation, frame_start, frame_end):
+            if curves_rotation and fcurve_index.keyframe_in_range(
+                    action, curves_rotation, frame_start, frame_end):
                 seq.rotationMatters[index] = True
 
-            if curves_translation and fcurves_keyframe_in_range(curves_translation, frame_start, frame_end):
+            if curves_translation and fcurve_index.keyframe_in_range(
+                    action, curves_translation, frame_start, frame_end):
                 seq.translationMatters[index] = True
 
-            if curves_scale and fcurves_keyframe_in_range(curves_scale, frame_start, frame_end):
+            if curves_scale and fcurve_index.keyframe_in_range(
+                    action, curves_scale, frame_start, frame_end):
                 seq.scaleMatters[index] = True
 
+            translations, rotations, scales = animation_data.track(ob, frame_start, frame_end)
+
+            # Blend sequences store the difference to the default pose
+            if seq.flags & Sequence.Blend:
+                translations, rotations = blend_track(
+                    translations, rotations, base_translation, base_rotation)
+                default_translation, default_rotation = (0.0, 0.0, 0.0), (1.0, 0.0, 0.0, 0.0)
+            else:
+                default_translation, default_rotation = base_translation, base_rotation
+
+            for track in drop_constant_tracks(seq, index, translations, rotations, scales,
+                                              default_translation, default_rotation,
+                                              (1.0, 1.0, 1.0)):
+                dropped_tracks.append("{} {}".format(ob.name, track))
+
             # Write the data where it matters
             # This assumes that animated_nodes is in the same order as shape.nodes
-            for frame in frame_indices:
-                translation, rotation, scale = animation_data[frame][ob]
+            if seq.translationMatters[index]:
+                dsq.translations.extend(map(Vector, translations))
 
-                if seq.translationMatters[index]:
-                    if seq.flags & Sequence.Blend:
-                        translation -= base_translation
-                    dsq.translations.append(translation)
+            if seq.rotationMatters[index]:
+                dsq.rotations.extend(map(Quaternion, rotations))
 
-                if seq.rotationMatters[index]:
-                    if seq.flags & Sequence.Blend:
-                        rotation = base_rotation.inverted() * rotation
-                    dsq.rotations.append(rotation)
+            if seq.scaleMatters[index]:
+                dsq.aligned_scales.extend(map(Vector, scales))
 
-                if seq.scaleMatters[index]:
-                    dsq.aligned_scales.append(scale)
+        if dropped_tracks:
+            print("Dropped {} unchanging tracks from sequence '{}': {}".format(
+                len(dropped_tracks), name, ", ".join(dropped_tracks)))
 
     with open(filepath, "wb") as fd:
         dsq.write(fd)
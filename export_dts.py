@@ -1,14 +1,25 @@
-import bpy, bmesh, os, sys
+import bpy, os, sys
 from math import sqrt, pi
 from operator import attrgetter
 from itertools import groupby
+from collections import OrderedDict
+from hashlib import sha1
+from struct import pack
+from copy import copy
+from concurrent.futures import ThreadPoolExecutor
 
 from .DtsShape import DtsShape
 from .DtsTypes import *
 from .write_report import write_debug_report
-from .util import fail, resolve_texture, default_materials, evaluate_all, find_reference, \
-    array_from_fcurves, array_from_fcurves_rotation, fcurves_keyframe_in_range
-from .shared_export import find_seqs
+from .util import fail, TextureIndex, default_materials, find_reference, FCurveIndex
+from .shared_export import find_seqs, check_seqs, sample_poses, drop_constant_tracks
+from .build_mesh import MeshData, build_meshes
+from .mesh_cache import MeshCache
+from .write_png import write_solid_png
+from .profiler import StageProfiler
+from .scene_snapshot import SceneSnapshot
+from .pose_store import blend_track
+from .normal_table import NormalEncoder, read_normal_table
 
 import re
 # re really isn't necessary. oh well.
@@ -27,48 +38,223 @@ def linearrgb_to_srgb(c):
     else:
         return 1.055 * (c ** (1.0 / 2.4)) - 0.055
 
-def get_vertex_bone(mesh, node):
-    for bone_index, (node_index, _) in enumerate(mesh.bones):
-        if node_index == node.index:
-            return bone_index
-
-    bone_index = len(mesh.bones)
+def get_bone_matrix(node):
     mat = node.bl_ob.matrix_local
 
     # TODO: Move this conversion to DtsTypes.py
-    flat_mat = [x for y in mat.row for x in y]
+    return [x for y in mat.row for x in y]
+
+def vertex_group_nodes(ob, armature, node_lookup):
+    # Resolve every vertex group to the node of its bone once per object
+    nodes = []
+
+    for vertex_group in ob.vertex_groups:
+        bone = armature.data.bones.get(vertex_group.name)
+
+        if bone is None:
+            nodes.append(None)
+        else:
+            nodes.append(node_lookup.get(bone) or None)
 
-    mesh.bones.append((node.index, flat_mat))
-    return bone_index
+    return nodes
 
-def add_vertex_influences(ob, armature, node_lookup, mesh, vert, vertex_index):
+def mesh_influences(mesh, group_nodes, bone_matrices, max_influences=0):
     influences = []
-    total_weight = 0
+    used_nodes = set()
 
-    for group in vert.groups:
-        vertex_group = ob.vertex_groups[group.group]
+    for vert in mesh.vertices:
+        weights = []
 
-        bone = armature.data.bones.get(vertex_group.name)
-        if bone is None:
-            continue
+        for group in vert.groups:
+            node = group_nodes[group.group]
 
-        node = node_lookup.get(bone)
-        if node is False:
-            continue
+            if node is not None:
+                weights.append((node, group.weight))
+
+        # Keep only the strongest influences if there is a limit
+        if max_influences and len(weights) > max_influences:
+            weights.sort(key=lambda influence: influence[1], reverse=True)
+            del weights[max_influences:]
 
-        influences.append((node, group.weight))
-        total_weight += group.weight
+        total_weight = sum(weight for _, weight in weights)
 
-    if total_weight == 0:
-        weight_multiplier = 1
+        if total_weight == 0:
+            weight_multiplier = 1
+        else:
+            weight_multiplier = 1 / total_weight
+
+        influences.append([(node.index, weight * weight_multiplier) for node, weight in weights])
+        used_nodes.update(node for node, _ in weights)
+
+    # In a stable order, so the mesh cache key does not change between exports
+    for node in sorted(used_nodes, key=attrgetter("index")):
+        bone_matrices[node.index] = get_bone_matrix(node)
+
+    return influences
+
+def distance_squared(a, b):
+    return (a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2 + (a[2] - b[2]) ** 2
+
+def polygon_triangles(positions, loops):
+    if len(loops) == 3:
+        return loops
+
+    # Split quads along their shorter diagonal
+    a, b, c, d = loops
+
+    if distance_squared(positions[a[0]], positions[c[0]]) <= \
+       distance_squared(positions[b[0]], positions[d[0]]):
+        return (a, b, c, a, c, d)
+    else:
+        return (b, c, d, b, d, a)
+
+def read_array(collection, attribute, width=1, default=0.0):
+    values = [default] * (len(collection) * width)
+    collection.foreach_get(attribute, values)
+    return values
+
+def read_vectors(collection, attribute, width=3, default=0.0):
+    values = read_array(collection, attribute, width, default)
+    return [tuple(values[i:i + width]) for i in range(0, len(values), width)]
+
+def polygon_faces(mesh, loop_totals):
+    material_indices = read_array(mesh.polygons, "material_index", default=0)
+    use_smooth = read_array(mesh.polygons, "use_smooth", default=False)
+    face_normals = read_vectors(mesh.polygons, "normal")
+    loop_starts = read_array(mesh.polygons, "loop_start", default=0)
+    loop_vertices = read_array(mesh.loops, "vertex_index", default=0)
+
+    if mesh.uv_layers:
+        uvs = [(u, 1 - v) for u, v in read_vectors(mesh.uv_layers[0].data, "uv", 2)]
     else:
-        weight_multiplier = 1 / total_weight
+        uvs = [(0, 0)] * len(loop_vertices)
+
+    face_corners = [tuple((loop_vertices[loop], uvs[loop])
+                          for loop in reversed(range(start, start + total)))
+                    for start, total in zip(loop_starts, loop_totals)]
+
+    return material_indices, use_smooth, face_normals, face_corners
 
-    for node, weight in influences:
-        mesh.influences.append((
-            vertex_index,
-            get_vertex_bone(mesh, node),
-            weight * weight_multiplier))
+def tessellated_faces(mesh):
+    # Blender breaks bigger polygons into triangles and quads here without
+    # rebuilding the mesh
+    mesh.calc_tessface()
+    faces = mesh.tessfaces
+
+    material_indices = read_array(faces, "material_index", default=0)
+    use_smooth = read_array(faces, "use_smooth", default=False)
+    face_normals = read_vectors(faces, "normal")
+
+    # Triangles have a 0 in the fourth slot, which quads never use there
+    vertices = read_vectors(faces, "vertices_raw", 4, default=0)
+
+    if mesh.tessface_uv_textures:
+        uvs = read_vectors(mesh.tessface_uv_textures[0].data, "uv_raw", 8)
+    else:
+        uvs = [(0.0,) * 8] * len(vertices)
+
+    face_corners = []
+
+    for face_vertices, face_uvs in zip(vertices, uvs):
+        count = 4 if face_vertices[3] else 3
+        face_corners.append(tuple((face_vertices[i], (face_uvs[2 * i], 1 - face_uvs[2 * i + 1]))
+                                  for i in reversed(range(count))))
+
+    return material_indices, use_smooth, face_normals, face_corners
+
+def mesh_corner_groups(mesh):
+    """Corners of the triangles of a mesh, grouped by material index"""
+    loop_totals = read_array(mesh.polygons, "loop_total", default=0)
+
+    # Triangles and quads are split while reading the corners
+    if all(total <= 4 for total in loop_totals):
+        faces = polygon_faces(mesh, loop_totals)
+    else:
+        faces = tessellated_faces(mesh)
+
+    material_indices, use_smooth, face_normals, face_corners = faces
+    positions = read_vectors(mesh.vertices, "co")
+    vertex_normals = read_vectors(mesh.vertices, "normal")
+
+    # Stable, so faces keep their order within each material
+    order = sorted(range(len(material_indices)), key=material_indices.__getitem__)
+    groups = []
+
+    for material_index, group_faces in groupby(order, key=material_indices.__getitem__):
+        corners = []
+
+        for face in group_faces:
+            for vert_index, uv in polygon_triangles(positions, face_corners[face]):
+                if use_smooth[face]:
+                    normal = vertex_normals[vert_index]
+                else:
+                    normal = face_normals[face]
+
+                corners.append((positions[vert_index], normal, uv, vert_index))
+
+        groups.append((material_index, corners))
+
+    return groups
+
+def mesh_source_key(bobj, armature_modifier, apply_modifiers):
+    # Objects with equal keys convert to the same mesh in their local space,
+    # None if that cannot be told from the object alone
+    modifiers = []
+
+    if apply_modifiers:
+        for modifier in bobj.modifiers:
+            # Disabled while converting
+            if modifier == armature_modifier:
+                continue
+
+            settings = []
+
+            for prop in modifier.bl_rna.properties:
+                if prop.identifier in ("rna_type", "name"):
+                    continue
+
+                value = getattr(modifier, prop.identifier)
+
+                # Collections like the UV Project projectors refer to other
+                # objects, and global coordinates depend on the placement
+                if prop.type == "COLLECTION":
+                    if len(value):
+                        return None
+                    continue
+                elif prop.type == "ENUM" and value == "GLOBAL":
+                    return None
+                elif prop.type == "POINTER":
+                    # The result depends on where another object is
+                    if isinstance(value, bpy.types.Object):
+                        return None
+                    elif value is not None and not isinstance(value, bpy.types.ID):
+                        return None
+                elif getattr(prop, "array_length", 0):
+                    value = tuple(value)
+                elif isinstance(value, set):
+                    value = frozenset(value)
+
+                settings.append((prop.identifier, value))
+
+            modifiers.append((modifier.type, tuple(settings)))
+
+    if armature_modifier is not None:
+        skin = armature_modifier.object
+    else:
+        skin = None
+
+    # Weights are stored by group index, but bones and modifiers refer to the
+    # groups through the names on the object
+    vertex_groups = tuple(group.name for group in bobj.vertex_groups)
+
+    if bobj.show_only_shape_key:
+        shape_key = bobj.active_shape_key_index
+    else:
+        shape_key = None
+
+    materials = tuple(slot.material for slot in bobj.material_slots)
+
+    return (bobj.data, shape_key, materials, skin, vertex_groups, tuple(modifiers))
 
 def export_material(mat, shape):
     # print("Exporting material", mat.name)
@@ -114,15 +300,17 @@ def export_material(mat, shape):
 def seq_float_eq(a, b):
     return all(abs(i - j) < 0.000001 for i, j in zip(a, b))
 
-def export_empty_node(lookup, shape, select_object, ob, parent=-1):
-    if select_object and not ob.select:
+def export_empty_node(lookup, shape, select_object, snapshot, info, parent=-1):
+    ob = info.ob
+
+    if select_object and not info.selected:
         lookup[ob] = False
         return
 
-    if "name" in ob:
-        name = ob["name"]
+    if info.custom_name is not None:
+        name = info.custom_name
     else:
-        name = undup_name(ob.name)
+        name = undup_name(info.name)
 
     node = Node(shape.name(name), parent)
 
@@ -133,9 +321,9 @@ def export_empty_node(lookup, shape, select_object, ob, parent=-1):
     shape.nodes.append(node)
     lookup[ob] = node
 
-    for child in ob.children:
+    for child in map(snapshot.get, info.children):
         if child.type == 'EMPTY':
-            export_empty_node(lookup, shape, select_object, child, node)
+            export_empty_node(lookup, shape, select_object, snapshot, child, node)
 
 def export_bones(lookup, shape, armature, bones, parent=-1):
     for bone in bones:
@@ -156,19 +344,16 @@ def export_bones(lookup, shape, armature, bones, parent=-1):
         lookup[bone] = node
         export_bones(lookup, shape, armature, bone.children, node)
 
-def save_nodes(scene, shape, select_object):
+def save_nodes(snapshot, shape, select_object):
     node_lookup = {}
 
     # Try to create nodes from empties armature bones
-    for ob in scene.objects:
-        if ob.parent is not None:
-            continue
-
-        if ob.type == 'EMPTY':
-            export_empty_node(node_lookup, shape, select_object, ob)
-        elif ob.type == 'ARMATURE' and (ob.select or not select_object):
-            top_bones = filter(lambda b: b.parent is None, ob.data.bones)
-            export_bones(node_lookup, shape, ob, top_bones)
+    for info in snapshot.roots():
+        if info.type == 'EMPTY':
+            export_empty_node(node_lookup, shape, select_object, snapshot, info)
+        elif info.type == 'ARMATURE' and (info.selected or not select_object):
+            top_bones = filter(lambda b: b.parent is None, info.ob.data.bones)
+            export_bones(node_lookup, shape, info.ob, top_bones)
 
     # NodeOrder backwards compatibility
     if "NodeOrder" in bpy.data.texts:
@@ -204,36 +389,35 @@ def save_nodes(scene, shape, select_object):
 
     return node_lookup
 
-def save_meshes(scene, shape, node_lookup, select_object):
+def save_meshes(snapshot, shape, node_lookup, select_object):
     scene_lods = {}
     scene_objects = {}
 
     auto_root_index = None
     bounds_ob = None
 
-    for bobj in scene.objects:
-        if bobj.type != "MESH":
-            continue
+    for info in snapshot.of_type("MESH"):
+        bobj = info.ob
 
-        if select_object and not bobj.select:
+        if select_object and not info.selected:
             continue
 
-        if bobj.name.lower() == "bounds":
+        if info.name.lower() == "bounds":
             if bounds_ob:
                 print("Warning: Multiple 'bounds' objects found - check capitalization")
             bounds_ob = bobj
             continue
 
-        if "name" in bobj:
-            name = bobj["name"]
+        if info.custom_name is not None:
+            name = info.custom_name
         else:
-            name = undup_name(bobj.name)
+            name = undup_name(info.name)
 
-        if bobj.users_group:
-            if len(bobj.users_group) > 1:
-                print("Warning: Mesh {} is in multiple groups".format(bobj.name))
+        if info.groups:
+            if len(info.groups) > 1:
+                print("Warning: Mesh {} is in multiple groups".format(info.name))
 
-            lod_name = bobj.users_group[0].name
+            lod_name = info.groups[0]
         elif common_col_name.match(name):
             lod_name = "collision-1"
         else:
@@ -243,29 +427,21 @@ def save_meshes(scene, shape, node_lookup, select_object):
             continue
 
         transform_mat = bobj.matrix_local
-        armature_modifier = None
-
-        # Try to find an armature modifier on the object
-        for modifier in bobj.modifiers:
-            if modifier.type != 'ARMATURE':
-                continue
-
-            armature_modifier = modifier
-            break
+        armature_modifier = info.armature_modifier
 
         if armature_modifier is not None:
             # Should we do something with the parent here?
             # Ignore it for now.
-            print('NYI: Armature modifier on mesh {}'.format(bobj.name))
+            print('NYI: Armature modifier on mesh {}'.format(info.name))
             attach_node = None
-        elif bobj.parent:
-            if bobj.parent_type == 'BONE':
-                armature = bobj.parent
-                bone = armature.data.bones[bobj.parent_bone]
+        elif info.parent:
+            if info.parent_type == 'BONE':
+                armature = info.parent
+                bone = armature.data.bones[info.parent_bone]
 
                 if bone not in node_lookup:
                     print('Ignoring mesh {} - parent bone {} not included'
-                          .format(bobj.name, bone.name))
+                          .format(info.name, bone.name))
                     continue
 
                 node = node_lookup[bone]
@@ -274,21 +450,22 @@ def save_meshes(scene, shape, node_lookup, select_object):
                 # Compensate for matrix_local pointing to tail, offset to head
                 # Does this need to use node.matrix somehow?
                 transform_mat = Matrix.Translation((0, bone.length, 0)) * transform_mat
-            elif bobj.parent_type == 'OBJECT':
-                if bobj.parent not in node_lookup:
-                    print("The mesh '{}' has a parent of type '{}' (named '{}'). You can only parent meshes to empties, not other meshes.".format(bobj.name, bobj.parent.type, bobj.parent.name))
+            elif info.parent_type == 'OBJECT':
+                if info.parent not in node_lookup:
+                    parent = snapshot.get(info.parent)
+                    print("The mesh '{}' has a parent of type '{}' (named '{}'). You can only parent meshes to empties, not other meshes.".format(info.name, parent.type, parent.name))
                     continue
 
-                if node_lookup[bobj.parent] is False: # not selected
+                if node_lookup[info.parent] is False: # not selected
                     continue
 
-                attach_node = node_lookup[bobj.parent].index
+                attach_node = node_lookup[info.parent].index
             else:
                 print('Warning: Mesh "{}" is using an unsupported parenting type "{}"'
-                      .format(bobj.name, bobj.parent_type))
+                      .format(info.name, info.parent_type))
                 attach_node = None
         else:
-            print("Warning: Mesh '{}' has no parent".format(bobj.name))
+            print("Warning: Mesh '{}' has no parent".format(info.name))
             attach_node = None
 
         if attach_node is None:
@@ -330,9 +507,8 @@ def save_meshes(scene, shape, node_lookup, select_object):
             shape.objectstates.append(ObjectState(1.0, 0, 0)) # ff56g: search for a37hm
             scene_objects[name] = (object, {})
 
-        for slot in bobj.material_slots:
-            if slot.material.use_transparency:
-                scene_objects[name][0].has_transparency = True
+        if info.has_transparency:
+            scene_objects[name][0].has_transparency = True
 
         if lod_name in scene_objects[name][1]:
             print("Warning: Multiple objects {} in LOD {}, ignoring...".format(name, lod_name))
@@ -341,6 +517,74 @@ def save_meshes(scene, shape, node_lookup, select_object):
 
     return scene_lods, scene_objects, bounds_ob
 
+def encode_normals(shape, encoder, tolerance):
+    # Every mesh gets its encoded normals, but the engine is only told to use
+    # them where they are close enough to the real ones
+    encoded = 0
+
+    for object in shape.objects:
+        for i in range(object.numMeshes):
+            mesh = shape.meshes[object.firstMesh + i]
+
+            if mesh.get_type() == Mesh.NullType:
+                continue
+
+            mesh.enormals, mean_error, max_error = encoder.encode_all(mesh.normals)
+            name = shape.names[object.name]
+            lod_name = shape.names[shape.detail_levels[i].name]
+
+            if max_error <= tolerance:
+                mesh.set_flags(Mesh.UseEncodedNormals)
+                encoded += 1
+
+                print("Encoded normals of '{}' (LOD '{}'): {:.2f} degrees mean error, {:.2f} max"
+                      .format(name, lod_name, mean_error, max_error))
+            else:
+                print("Note: Not using encoded normals for '{}' (LOD '{}'), {:.2f} degrees max error is above the tolerance"
+                      .format(name, lod_name, max_error))
+
+    return encoded
+
+def mesh_geometry_key(mesh):
+    # Hash the vertex data as it ends up in the file, so that meshes
+    # only share it when their own copies would be byte-identical
+    floats = [x for vert in mesh.verts for x in vert]
+    floats.extend(x for tvert in mesh.tverts for x in tvert)
+    floats.extend(x for normal in mesh.normals for x in normal)
+
+    digest = sha1(pack("<3I", mesh.get_type(), len(mesh.verts), len(mesh.tverts)))
+    digest.update(pack("<{}f".format(len(floats)), *floats))
+    digest.update(bytes(mesh.enormals))
+
+    if mesh.get_type() == Mesh.SkinType:
+        for node_index, initial_transform in mesh.bones:
+            digest.update(pack("<i16f", node_index, *initial_transform))
+        for vertex_index, bone_index, weight in mesh.influences:
+            digest.update(pack("<2if", vertex_index, bone_index, weight))
+
+    return digest.digest()
+
+def share_mesh_geometry(shape):
+    # Later meshes with the same vertex data only keep their primitives and
+    # point at the first one through Mesh.parent
+    first_meshes = {}
+    shared = 0
+
+    for index, mesh in enumerate(shape.meshes):
+        if mesh.get_type() == Mesh.NullType or mesh.parent >= 0:
+            continue
+
+        parent = first_meshes.setdefault(mesh_geometry_key(mesh), index)
+
+        if parent != index:
+            mesh.parent = parent
+            shared += 1
+
+    if shared:
+        print("Note: {} meshes share the geometry of an earlier mesh".format(shared))
+
+    return shared
+
 def compute_bounds(shape, bounds_ob):
     print("Computing bounds")
 
@@ -390,18 +634,64 @@ def compute_bounds(shape, bounds_ob):
         (shape.bounds.min.y + shape.bounds.max.y) / 2,
         (shape.bounds.min.z + shape.bounds.max.z) / 2))
 
+def generate_detail_levels(shape, targets):
+    # Hand-made detail levels take precedence over generated ones
+    visible = [lod for lod in shape.detail_levels if lod.size >= 0]
+
+    if len(visible) != 1:
+        if visible:
+            print("Note: Not generating detail levels, the shape already has {}".format(len(visible)))
+
+        return None, {}
+
+    top = visible[0]
+    size = top.size
+    generated = {}
+
+    for target in targets:
+        size //= 2
+
+        if size < 1:
+            print("Warning: Detail level sizes run out after {} generated levels".format(len(generated)))
+            break
+
+        lod_name_index, lod_name = shape.name_resolve("detail{}".format(size))
+        print("Creating LOD '{}' (size {}, target {})".format(lod_name, size, target))
+
+        shape.detail_levels.append(DetailLevel(name=lod_name_index, subshape=0, objectDetail=-1, size=size))
+        generated[lod_name] = target
+
+    shape.detail_levels.sort(key=attrgetter("size"), reverse=True)
+    return shape.names[top.name], generated
+
 def save(operator, context, filepath,
          select_object=False,
          select_marker=False,
          blank_material=True,
          generate_texture="disabled",
          apply_modifiers=True,
+         weld_vertices=True,
+         use_strips=False,
+         optimize_cache=False,
+         worker_count=1,
+         use_mesh_cache=False,
+         mesh_cache_size=256,
+         max_influences=0,
+         sort_translucent=True,
+         bone_palette_size=0,
+         generate_lods=False,
+         lod_targets="0.5, 0.25, 0.125",
+         normal_table="",
+         normal_tolerance=10.0,
+         share_geometry=True,
+         write_profile=False,
          debug_report=False):
     print("Exporting scene to DTS")
 
     scene = context.scene
     active = context.active_object
     shape = DtsShape()
+    profile = StageProfiler()
 
     blank_material_index = None
 
@@ -411,35 +701,63 @@ def save(operator, context, filepath,
         print("Note: Seeking to reference frame at", reference_frame)
         scene.frame_set(reference_frame)
 
-    node_lookup = save_nodes(scene, shape, select_object)
+    stage = profile.begin("snapshot_scene")
+    snapshot = SceneSnapshot(scene)
+    stage.finish(objects=len(snapshot.objects))
+
+    stage = profile.begin("save_nodes")
+    node_lookup = save_nodes(snapshot, shape, select_object)
+    stage.finish(nodes=len(shape.nodes))
+
+    stage = profile.begin("save_meshes")
     scene_lods, scene_objects, bounds_ob = save_meshes(
-        scene, shape, node_lookup, select_object)
+        snapshot, shape, node_lookup, select_object)
+    stage.finish(objects=len(scene_objects), detail_levels=len(scene_lods))
 
     # If the shape is empty, add a detail level so it is valid
     if not shape.detail_levels:
         dl = DetailLevel(name=shape.name('detail1'), subshape=0, objectDetail=-1, size=1)
         shape.detail_levels.append(dl)
 
-    # Put objects with transparent materials last
-    # Note: If this plugin ever needs to do anything with objectstates,
-    #       that needs to be handled properly. a37hm: earch for ff56g
-    shape.objects.sort(key=lambda object: object.has_transparency) # TODO: attrgetter
-
     # Sort detail levels
     shape.detail_levels.sort(key=attrgetter("size"), reverse=True)
 
+    if generate_lods:
+        try:
+            targets = [float(part) for part in lod_targets.split(",") if part.strip()]
+        except ValueError:
+            return fail(operator, "Invalid detail level targets '{}'".format(lod_targets))
+
+        top_lod_name, generated_lods = generate_detail_levels(shape, targets)
+    else:
+        top_lod_name, generated_lods = None, {}
+
     for i, lod in enumerate(shape.detail_levels):
         lod.objectDetail = i # this isn't the right place for this
 
     print("Adding meshes to objects...")
 
     material_table = {}
+    split_chunks = OrderedDict()
+
+    mesh_jobs = []
+    mesh_slots = []
+    converted_meshes = {}
+
+    extract_stage = profile.begin("extract_meshes")
 
     for object, lods in scene_objects.values():
         object.firstMesh = len(shape.meshes)
+        top_data = None
+
+        # Objects in the top detail level also get the generated ones
+        present = set(lods)
+
+        if top_lod_name in lods:
+            present.update(generated_lods)
 
         for i, lod in enumerate(reversed(shape.detail_levels)):
-            if shape.names[lod.name] in lods:
+            if shape.names[lod.name] in present:
                 object.numMeshes = len(shape.detail_levels) - i
                 break
         else:
@@ -453,6 +771,7 @@ def save(operator, context, filepath,
             if lod_name in lods:
                 print("Exporting mesh '{}' (LOD '{}')".format(shape.names[object.name], lod_name))
                 bobj, transform_mat, armature_modifier = lods[lod_name]
+                stage = profile.begin("{} ({})".format(bobj.name, lod_name), "object", extract_stage)
 
                 if armature_modifier is None:
                     mesh_type = Mesh.StandardType
@@ -460,141 +779,225 @@ def save(operator, context, filepath,
                     mesh_type = Mesh.SkinType
                     armature = armature_modifier.object
 
-                #########################
-                ### Welcome to complexity
-
-                # Disable the armature modifier so it does not deform the mesh
-                # when writing it to the DTS file
-                if armature_modifier is not None:
-                    was_show_render = armature_modifier.show_render
-                    was_show_viewport = armature_modifier.show_viewport
-
-                    armature_modifier.show_render = False
-                    armature_modifier.show_viewport = False
-
-                mesh = bobj.to_mesh(scene, apply_modifiers, "PREVIEW")
-                bm = bmesh.new()
-                bm.from_mesh(mesh)
-                bmesh.ops.triangulate(bm, faces=bm.faces)
-                bm.to_mesh(mesh)
-                bm.free()
-
-                # Restore the armature modifier
-                if armature_modifier is not None:
-                    armature_modifier.show_render = was_show_render
-                    armature_modifier.show_viewport = was_show_viewport
-
-                # This is the danger zone
-                # Data from down here may not stay around!
-
-                dmesh = Mesh(mesh_type)
-                shape.meshes.append(dmesh)
-
-                dmesh.matrix_world = bobj.matrix_world
-
-                dmesh.bounds = dmesh.calculate_bounds_mat(Matrix())
-                #dmesh.center = Vector((
-                #    (dmesh.bounds.min.x + dmesh.bounds.max.x) / 2,
-                #    (dmesh.bounds.min.y + dmesh.bounds.max.y) / 2,
-                #    (dmesh.bounds.min.z + dmesh.bounds.max.z) / 2))
-                dmesh.center = Vector()
-                dmesh.radius = dmesh.calculate_radius_mat(Matrix(), dmesh.center)
-
-                # Group all materials by their material_index
-                key = attrgetter("material_index")
-                grouped_polys = groupby(sorted(mesh.polygons, key=key), key=key)
-                grouped_polys = tuple(map(lambda t: (t[0], tuple(t[1])), grouped_polys))
-
-                # Create a primitive from each group
-                for material_index, polys in grouped_polys:
-                    flags = Primitive.Triangles | Primitive.Indexed
-
-                    if mesh.materials:
-                        bmat = mesh.materials[material_index]
-
-                        if bmat not in material_table:
-                            material_table[bmat] = export_material(bmat, shape)
-
-                        flags |= material_table[bmat] & Primitive.MaterialMask
-                    elif blank_material:
-                        if blank_material_index is None:
-                            blank_material_index = len(shape.materials)
-                            shape.materials.append(Material(name="blank",
-                                flags=Material.SWrap | Material.TWrap | Material.NeverEnvMap))
-
-                        flags |= blank_material_index & Primitive.MaterialMask
-                    else:
-                        flags |= Primitive.NoMaterial
-
-                    firstElement = len(dmesh.verts)
-
-                    for poly in polys:
-                        if mesh.uv_layers:
-                            uv_layer = mesh.uv_layers[0].data
-                        else:
-                            uv_layer = None
+                transform = tuple(tuple(row) for row in transform_mat.row)
 
-                        use_face_normal = not poly.use_smooth
+                # Linked duplicates convert to the same local mesh, only
+                # the transform differs
+                source_key = mesh_source_key(bobj, armature_modifier, apply_modifiers)
+                shared = converted_meshes.get(source_key)
 
-                        for vert_index, loop_index in zip(reversed(poly.vertices), reversed(poly.loop_indices)):
-                            vertex_index = len(dmesh.verts)
-                            dmesh.indices.append(len(dmesh.indices))
+                if shared is not None:
+                    data = copy(shared)
+                    data.name = bobj.name
+                    data.transform = transform
 
-                            vert = mesh.vertices[vert_index]
+                    stage.finish(shared=True)
+                else:
+                    #########################
+                    ### Welcome to complexity
 
-                            if use_face_normal:
-                                normal = poly.normal
-                            else:
-                                normal = vert.normal
+                    # Disable the armature modifier so it does not deform the mesh
+                    # when writing it to the DTS file
+                    if armature_modifier is not None:
+                        was_show_render = armature_modifier.show_render
+                        was_show_viewport = armature_modifier.show_viewport
 
-                            dmesh.verts.append(transform_mat * vert.co)
-                            dmesh.normals.append((transform_mat.to_3x3() * normal).normalized())
+                        armature_modifier.show_render = False
+                        armature_modifier.show_viewport = False
 
-                            dmesh.enormals.append(0)
+                    mesh = bobj.to_mesh(scene, apply_modifiers, "PREVIEW")
 
-                            if uv_layer:
-                                uv = uv_layer[loop_index].uv
-                                dmesh.tverts.append(Vector((uv.x, 1 - uv.y)))
-                            else:
-                                dmesh.tverts.append(Vector((0, 0)))
+                    # Restore the armature modifier
+                    if armature_modifier is not None:
+                        armature_modifier.show_render = was_show_render
+                        armature_modifier.show_viewport = was_show_viewport
 
-                            if mesh_type == Mesh.SkinType:
-                                add_vertex_influences(bobj, armature,
-                                                      node_lookup, dmesh,
-                                                      vert, vertex_index)
+                    # This is the danger zone
+                    # Data from down here may not stay around!
 
-                    numElements = len(dmesh.verts) - firstElement
-                    dmesh.primitives.append(Primitive(firstElement, numElements, flags))
+                    data = MeshData(bobj.name, mesh_type, transform)
 
-                bpy.data.meshes.remove(mesh) # RIP!
+                    # Weights are read once per vertex, corners refer to them by index
+                    if mesh_type == Mesh.SkinType:
+                        group_nodes = vertex_group_nodes(bobj, armature, node_lookup)
+                        data.influences = mesh_influences(mesh, group_nodes,
+                                                          data.bone_matrices, max_influences)
 
-                # ??? ? ?? ???? ??? ?
-                dmesh.vertsPerFrame = len(dmesh.verts)
+                    # Snapshot the corners of each material, building the DTS mesh
+                    # from them happens later and does not need Blender
+                    for material_index, corners in mesh_corner_groups(mesh):
+                        flags = Primitive.Triangles | Primitive.Indexed
+
+                        if mesh.materials:
+                            bmat = mesh.materials[material_index]
+
+                            if bmat not in material_table:
+                                material_table[bmat] = export_material(bmat, shape)
+
+                            flags |= material_table[bmat] & Primitive.MaterialMask
+                        elif blank_material:
+                            if blank_material_index is None:
+                                blank_material_index = len(shape.materials)
+                                shape.materials.append(Material(name="blank",
+                                    flags=Material.SWrap | Material.TWrap | Material.NeverEnvMap))
+
+                            flags |= blank_material_index & Primitive.MaterialMask
+                        else:
+                            flags |= Primitive.NoMaterial
 
-                if len(dmesh.indices) >= 65536:
-                    return fail(operator, "The mesh '{}' has too many vertex indices ({} >= 65536)".format(bobj.name, len(dmesh.indices)))
+                        data.groups.append((flags, corners))
+
+                    stage.finish(vertices=len(mesh.vertices), polygons=len(mesh.polygons))
+                    bpy.data.meshes.remove(mesh) # RIP!
+
+                    if source_key is not None:
+                        converted_meshes[source_key] = data
+
+                if lod_name == top_lod_name:
+                    top_data = (data, bobj)
+
+                mesh_jobs.append(data)
+                mesh_slots.append((object, i, len(shape.meshes), bobj))
+                shape.meshes.append(None) # Filled in once built
 
                 ### Nobody leaves Hotel California
+            elif lod_name in present:
+                print("Generating mesh '{}' (LOD '{}')".format(shape.names[object.name], lod_name))
+                data, bobj = top_data
+
+                # Simplified from the top detail level while building
+                data = copy(data)
+                data.simplify = generated_lods[lod_name]
+
+                mesh_jobs.append(data)
+                mesh_slots.append((object, i, len(shape.meshes), bobj))
+                shape.meshes.append(None)
             else:
                 # print("Adding Null mesh for object {} in LOD {}".format(shape.names[object.name], lod_name))
                 shape.meshes.append(Mesh(Mesh.NullType))
 
+    extract_stage.finish(meshes=len(mesh_jobs))
+
+    if sort_translucent:
+        sorted_materials = tuple(index for index, material in enumerate(shape.materials)
+                                 if material.flags & Material.Translucent)
+
+        for data in mesh_jobs:
+            data.sorted_materials = sorted_materials
+
+    print("Building {} meshes...".format(len(mesh_jobs)))
+    stage = profile.begin("build_meshes")
+
+    if use_mesh_cache:
+        cache = MeshCache(bpy.utils.user_resource("DATAFILES", "io_scene_dts_cache"),
+                          mesh_cache_size * 1024 * 1024)
+    else:
+        cache = None
+
+    mesh_results = build_meshes(mesh_jobs, worker_count, cache,
+                                weld_vertices=weld_vertices,
+                                use_strips=use_strips,
+                                optimize_cache=optimize_cache,
+                                palette_size=bone_palette_size)
+
+    stage.finish(meshes=len(mesh_jobs),
+                 vertices=sum(len(chunk.verts) for chunks in mesh_results for chunk in chunks))
+
+    if cache is not None:
+        print("Mesh cache: {} reused, {} built".format(cache.hits, cache.misses))
+
+    for (object, i, mesh_index, bobj), chunks in zip(mesh_slots, mesh_results):
+        if len(chunks) > 1:
+            if bone_palette_size:
+                limits = "65536 vertices and {} bones".format(bone_palette_size)
+            else:
+                limits = "65536 vertices"
+
+            print("Splitting mesh '{}' into {} pieces to stay below {}"
+                  .format(bobj.name, len(chunks), limits))
+
+        for chunk in chunks:
+            chunk.matrix_world = bobj.matrix_world
+
+            if bone_palette_size and len(chunk.bones) > bone_palette_size:
+                print("Warning: Triangles of mesh '{}' use {} bones together, more than the palette size of {}"
+                      .format(bobj.name, len(chunk.bones), bone_palette_size))
+
+            if hasattr(chunk, "acmr"):
+                print("Vertex cache ACMR for '{}' {:.3f} -> {:.3f}".format(bobj.name, *chunk.acmr))
+
+            # Primitive ranges are 16-bit as well
+            for prim in chunk.primitives:
+                if prim.firstElement > 65535 or prim.numElements > 65535:
+                    return fail(operator, "The mesh '{}' has too many vertex indices ({} > 65535 in one material)".format(bobj.name, len(chunk.indices)))
+
+        shape.meshes[mesh_index] = chunks[0]
+
+        for piece, chunk in enumerate(chunks[1:]):
+            split_chunks.setdefault((object, piece), {})[i] = chunk
+
+    # Further pieces of split meshes become their own objects
+    for (object, piece), chunks in split_chunks.items():
+        name = "{}_{}".format(shape.names[object.name], piece + 2)
+        piece_object = Object(shape.name(name), numMeshes=max(chunks) + 1,
+                              firstMesh=len(shape.meshes), node=object.node)
+        piece_object.has_transparency = object.has_transparency
+        shape.objects.append(piece_object)
+        shape.objectstates.append(ObjectState(1.0, 0, 0)) # ff56g: search for a37hm
+
+        for i in range(piece_object.numMeshes):
+            shape.meshes.append(chunks.get(i, Mesh(Mesh.NullType)))
+
+    if normal_table:
+        stage = profile.begin("encode_normals")
+
+        try:
+            encoder = NormalEncoder(read_normal_table(bpy.path.abspath(normal_table)))
+        except (OSError, ValueError) as e:
+            return fail(operator, "Cannot read the normal table: {}".format(e))
+
+        stage.finish(encoded=encode_normals(shape, encoder, normal_tolerance))
+
+    # Encoded normals are part of the shared geometry, so this comes after them
+    if share_geometry:
+        stage = profile.begin("share_geometry")
+        stage.finish(shared=share_mesh_geometry(shape))
+
+    # Put objects with transparent materials last
+    # Note: If this plugin ever needs to do anything with objectstates,
+    #       that needs to be handled properly. a37hm: earch for ff56g
+    shape.objects.sort(key=lambda object: object.has_transparency) # TODO: attrgetter
+
     print("Creating subshape with " + str(len(shape.nodes)) + " nodes and " + str(len(shape.objects)) + " objects")
     shape.subshapes.append(Subshape(0, 0, 0, len(shape.nodes), len(shape.objects), 0))
 
     # Figure out all the things
+    stage = profile.begin("compute_bounds")
     compute_bounds(shape, bounds_ob)
+    stage.finish()
 
     sequences, sequence_flags = find_seqs(context.scene, select_marker)
 
-    for name, markers in sequences.items():
-        print("Exporting sequence", name)
+    error = check_seqs(sequences)
+
+    if error is not None:
+        return fail(operator, error)
+
+    fcurve_index = FCurveIndex()
 
-        if "start" not in markers:
-            return fail(operator, "Missing start marker for sequence '{}'".format(name))
+    animated_nodes = [(node, node.bl_ob) for node in shape.nodes
+                      if node.armature is None and node.bl_ob is not None and
+                      snapshot.get(node.bl_ob).animated]
 
-        if "end" not in markers:
-            return fail(operator, "Missing end marker for sequence '{}'".format(name))
+    stage = profile.begin("sample_nodes")
+    animation_data = sample_poses(scene, animated_nodes, sequences, fcurve_index)
+    stage.finish(frames=len(animation_data.frames))
+
+    sequences_stage = profile.begin("sequences")
+
+    for name, markers in sequences.items():
+        print("Exporting sequence", name)
+        stage = profile.begin(name, "sequence", sequences_stage)
 
         frame_start = markers["start"].frame
         frame_end = markers["end"].frame
@@ -644,19 +1047,7 @@ def save(operator, context, filepath,
 
         shape.sequences.append(seq)
 
-        frame_indices = list(range(frame_start, frame_end + 1))
-
-        # Store all animation data so we don't need to frame_set all over the place
-        animation_data = {frame: {} for frame in frame_indices}
-
-        for frame in frame_indices:
-            scene.frame_set(frame)
-
-            for node in shape.nodes:
-                if node.armature is not None:
-                    continue
-
-                animation_data[frame][node] = node.matrix.decompose()
+        dropped_tracks = []
 
         for index, node in enumerate(shape.nodes):
             if node.armature is not None:
@@ -664,49 +1055,64 @@ def save(operator, context, filepath,
 
             ob = node.bl_ob
 
-            if ob is None:
+            if node not in animation_data:
                 continue
 
-            data = ob.animation_data
-
-            if not data or not data.action or not len(data.action.fcurves):
-                continue
+            base_translation = tuple(shape.default_translations[index])
+            base_rotation = tuple(shape.default_rotations[index])
 
-            base_translation, base_rotation, _ = node.matrix.decompose()
-            base_scale = Vector((1.0, 1.0, 1.0))
+            action = ob.animation_data.action
 
-            fcurves = data.action.fcurves
-
-            curves_rotation = array_from_fcurves_rotation(fcurves, ob)
-            curves_translation = array_from_fcurves(fcurves, "location", 3)
-            curves_scale = array_from_fcurves(fcurves, "scale", 3)
+            curves_rotation = fcurve_index.rotation_curves(action, ob)
+            curves_translation = fcurve_index.curves(action, "location", 3)
+            curves_scale = fcurve_index.curves(action, "scale", 3)
 
             # Decide what matters by presence of f-curves
-            if curves_rotation and fcurves_keyframe_in_range(curves_rotation, frame_start, frame_end):
+            if curves_rotation and fcurve_index.keyframe_in_range(
+                    action, curves_rotation, frame_start, frame_end):
                 seq.rotationMatters[index] = True
 
-            if curves_translation and fcurves_keyframe_in_range(curves_translation, frame_start, frame_end):
+            if curves_translation and fcurve_index.keyframe_in_range(
+                    action, curves_translation, frame_start, frame_end):
                 seq.translationMatters[index] = True
 
-            if curves_scale and fcurves_keyframe_in_range(curves_scale, frame_start, frame_end):
+            if curves_scale and fcurve_index.keyframe_in_range(
+                    action, curves_scale, frame_start, frame_end):
                 seq.scaleMatters[index] = True
 
+            translations, rotations, scales = animation_data.track(node, frame_start, frame_end)
+
+            # Blend sequences store the difference to the default pose
+            if seq.flags & Sequence.Blend:
+                translations, rotations = blend_track(
+                    translations, rotations, base_translation, base_rotation)
+                default_translation, default_rotation = (0.0, 0.0, 0.0), (1.0, 0.0, 0.0, 0.0)
+            else:
+                default_translation, default_rotation = base_translation, base_rotation
+
+            for track in drop_constant_tracks(seq, index, translations, rotations, scales,
+                                              default_translation, default_rotation,
+                                              (1.0, 1.0, 1.0)):
+                dropped_tracks.append("{} {}".format(ob.name, track))
+
             # Write the data where it matters
-            for frame in frame_indices:
-                translation, rotation, scale = animation_data[frame][node]
+            if seq.translationMatters[index]:
+                shape.node_translations.extend(map(Vector, translations))
 
-                if seq.translationMatters[index]:
-                    if seq.flags & Sequence.Blend:
-                        translation -= base_translation
-                    shape.node_translations.append(translation)
+            if seq.rotationMatters[index]:
+                shape.node_rotations.extend(map(Quaternion, rotations))
 
-                if seq.rotationMatters[index]:
-                    if seq.flags & Sequence.Blend:
-                        rotation = base_rotation.inverted() * rotation
-                    shape.node_rotations.append(rotation)
+            if seq.scaleMatters[index]:
+                shape.node_aligned_scales.extend(map(Vector, scales))
 
-                if seq.scaleMatters[index]:
-                    shape.node_aligned_scales.append(scale)
+        if dropped_tracks:
+            print("Dropped {} unchanging tracks from sequence '{}': {}".format(
+                len(dropped_tracks), name, ", ".join(dropped_tracks)))
+
+        tracks = sum(seq.rotationMatters) + sum(seq.translationMatters) + sum(seq.scaleMatters)
+        stage.finish(frames=frame_range, tracks=tracks, keyframes=tracks * frame_range)
+
+    sequences_stage.finish(sequences=len(sequences))
 
     if debug_report:
         print("Writing debug report")
@@ -714,10 +1120,21 @@ def save(operator, context, filepath,
 
     shape.verify()
 
+    stage = profile.begin("write_shape")
+
     with open(filepath, "wb") as fd:
         shape.save(fd)
 
+    stage.finish()
+
+    stage = profile.begin("write_textures")
     write_material_textures(generate_texture, filepath, shape)
+    stage.finish()
+
+    if write_profile:
+        print("Export profile:")
+        profile.print_summary()
+        profile.write_json(filepath + ".profile.json")
 
     return {"FINISHED"}
 
@@ -728,6 +1145,9 @@ def write_material_textures(mode, filepath, shape):
     f_lookup = mode in ("custom-missing", "all-missing")
     f_custom = mode in ("custom-missing", "custom-always")
 
+    texture_index = TextureIndex(filepath)
+    textures = []
+
     for material in shape.materials:
         if not hasattr(material, "bl_mat"):
             continue
@@ -735,17 +1155,26 @@ def write_material_textures(mode, filepath, shape):
         if f_custom and material.name.lower() in default_materials:
             continue
 
-        if f_lookup and resolve_texture(filepath, material.name) is not None:
+        if f_lookup and texture_index.resolve(material.name) is not None:
             continue
 
         bl_mat = material.bl_mat
         color = bl_mat.diffuse_color * bl_mat.diffuse_intensity
-        color.r = linearrgb_to_srgb(color.r)
-        color.g = linearrgb_to_srgb(color.g)
-        color.b = linearrgb_to_srgb(color.b)
-
-        image = bpy.data.images.new(material.name.lower() + "_generated", 16, 16)
-        image.pixels = (color.r, color.g, color.b, 1.0) * 256
-        image.filepath_raw = os.path.join(os.path.dirname(filepath), material.name + ".png")
-        image.file_format = "PNG"
-        image.save()
+        color = (
+            linearrgb_to_srgb(color.r),
+            linearrgb_to_srgb(color.g),
+            linearrgb_to_srgb(color.b),
+            1.0)
+
+        textures.append((os.path.join(os.path.dirname(filepath), material.name + ".png"), color))
+
+    if not textures:
+        return
+
+    # The images are written directly, so this does not need Blender and
+    # can run alongside itself
+    with ThreadPoolExecutor(min(len(textures), os.cpu_count() or 1)) as executor:
+        written = sum(executor.map(lambda texture: write_solid_png(*texture), textures))
+
+    print("Generated {} textures ({} already up to date)".format(
+        len(textures), len(textures) - written))
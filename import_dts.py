@@ -5,7 +5,8 @@ from bpy_extras.io_utils import unpack_list
 from .DtsShape import DtsShape
 from .DtsTypes import *
 from .write_report import write_debug_report
-from .util import default_materials, resolve_texture, get_rgb_colors, fail, \
+from .normal_table import read_normal_table
+from .util import default_materials, TextureIndex, get_rgb_colors, fail, \
     ob_location_curves, ob_scale_curves, ob_rotation_curves, ob_rotation_data, evaluate_all
 
 import operator
@@ -29,11 +30,11 @@ def dedup_name(group, name):
         if new_name not in group:
             return new_name
 
-def import_material(color_source, dmat, filepath):
+def import_material(color_source, dmat, texture_index):
     bmat = bpy.data.materials.new(dedup_name(bpy.data.materials, dmat.name))
     bmat.diffuse_intensity = 1
 
-    texname = resolve_texture(filepath, dmat.name)
+    texname = texture_index.resolve(dmat.name)
 
     if texname is not None:
         try:
@@ -119,7 +120,10 @@ def create_bmesh(dmesh, materials, shape):
         if prim.type & Primitive.Strip:
             even = True
             for i in range(prim.firstElement + 2, prim.firstElement + prim.numElements):
-                if even:
+                # Strips are joined with degenerate triangles, skip those
+                if indices[i] in (indices[i - 1], indices[i - 2]) or indices[i - 1] == indices[i - 2]:
+                    pass
+                elif even:
                     faces.append(((indices[i], indices[i - 1], indices[i - 2]), dmat))
                 else:
                     faces.append(((indices[i - 2], indices[i - 1], indices[i]), dmat))
@@ -197,12 +201,28 @@ def load(operator, context, filepath,
          reference_keyframe=True,
          import_sequences=True,
          use_armature=False,
+         normal_table="",
          debug_report=False):
     shape = DtsShape()
 
     with open(filepath, "rb") as fd:
         shape.load(fd)
 
+    if normal_table:
+        try:
+            table = read_normal_table(bpy.path.abspath(normal_table))
+        except (OSError, ValueError) as e:
+            return fail(operator, "Cannot read the normal table: {}".format(e))
+
+        # Shared geometry is the same list, so only decode it once
+        decoded = set()
+
+        for mesh in shape.meshes:
+            if mesh.get_type() != Mesh.NullType and mesh.get_flags(Mesh.UseEncodedNormals) \
+               and id(mesh.normals) not in decoded:
+                mesh.normals[:] = [Vector(table[index]) for index in mesh.enormals]
+                decoded.add(id(mesh.normals))
+
     if debug_report:
         write_debug_report(filepath + ".txt", shape)
         with open(filepath + ".pass.dts", "wb") as fd:
@@ -211,9 +231,10 @@ def load(operator, context, filepath,
     # Create a Blender material for each DTS material
     materials = {}
     color_source = get_rgb_colors()
+    texture_index = TextureIndex(filepath)
 
     for dmat in shape.materials:
-        materials[dmat] = import_material(color_source, dmat, filepath)
+        materials[dmat] = import_material(color_source, dmat, texture_index)
 
     # Now assign IFL material properties where needed
     for ifl in shape.iflmaterials:
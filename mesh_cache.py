@@ -0,0 +1,96 @@
+import os
+import pickle
+import hashlib
+import tempfile
+
+def source_version():
+    # Any change to the code building meshes starts a new set of entries
+    digest = hashlib.sha1()
+    directory = os.path.dirname(__file__)
+
+    for name in ("build_mesh.py", "optimize.py", "simplify.py", "DtsTypes.py"):
+        with open(os.path.join(directory, name), "rb") as fd:
+            digest.update(fd.read())
+
+    return digest.hexdigest()
+
+cache_version = source_version()
+
+class MeshCache:
+    """On-disk store of built DTS meshes, keyed on the snapshot they came from"""
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, data, options):
+        # The snapshot already reflects modifiers, materials (through the
+        # primitive flags) and the object transform. The name does not
+        # change the result, so identical meshes share an entry.
+        contents = dict(data.__dict__)
+        del contents["name"]
+
+        blob = pickle.dumps(
+            (cache_version, sorted(options.items()), sorted(contents.items())),
+            protocol=pickle.HIGHEST_PROTOCOL)
+        return hashlib.sha1(blob).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".mesh")
+
+    def get(self, key):
+        path = self.path(key)
+
+        try:
+            with open(path, "rb") as fd:
+                chunks = pickle.load(fd)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception:
+            # Entries written by another version or location of the add-on
+            # may fail to load in any number of ways
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+            self.misses += 1
+            return None
+
+        # Mark as recently used for eviction
+        os.utime(path, None)
+        self.hits += 1
+        return chunks
+
+    def put(self, key, chunks):
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+
+        with os.fdopen(fd, "wb") as fd:
+            pickle.dump(chunks, fd, protocol=pickle.HIGHEST_PROTOCOL)
+
+        os.replace(temp_path, self.path(key))
+
+    def evict(self):
+        entries = []
+
+        for name in os.listdir(self.directory):
+            if not name.endswith(".mesh"):
+                continue
+
+            stat = os.stat(os.path.join(self.directory, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+
+        # Drop the least recently used entries until everything fits
+        for _, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+
+            os.remove(os.path.join(self.directory, name))
+            total -= size
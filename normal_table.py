@@ -0,0 +1,113 @@
+import re
+from math import acos, degrees, floor, sqrt
+
+# Float triples as the engine source writes them, "Point3F( 0.5f, -0.25f, 0.8f )"
+re_triple = re.compile(r"(-?\d*\.\d+)f?\s*,\s*(-?\d*\.\d+)f?\s*,\s*(-?\d*\.\d+)f?")
+
+# Cells along each edge of a cube face in the lookup grid
+grid_size = 8
+
+def read_normal_table(filepath):
+    """Read the 256 directions of the engine's encoded normal table from a text file"""
+    with open(filepath) as fd:
+        table = [tuple(map(float, match.groups())) for match in re_triple.finditer(fd.read())]
+
+    if len(table) != 256:
+        raise ValueError("expected 256 normals in '{}', found {}".format(filepath, len(table)))
+
+    return table
+
+def dot(a, b):
+    return a[0] * b[0] + a[1] * b[1] + a[2] * b[2]
+
+def normalized(v):
+    length = sqrt(dot(v, v))
+    return (v[0] / length, v[1] / length, v[2] / length)
+
+def angle(a, b):
+    # Both unit length
+    return acos(max(-1.0, min(1.0, dot(a, b))))
+
+def face_direction(face, u, v):
+    # Face 0-5 is +X, -X, +Y, -Y, +Z, -Z with u and v along the other axes
+    axis, sign = divmod(face, 2)
+    direction = [u, v]
+    direction.insert(axis, -1.0 if sign else 1.0)
+    return normalized(direction)
+
+def grid_cell(direction):
+    x, y, z = map(abs, direction)
+
+    if x >= y and x >= z:
+        axis = 0
+    elif y >= z:
+        axis = 1
+    else:
+        axis = 2
+
+    major = direction[axis]
+    u, v = (direction[i] / abs(major) for i in range(3) if i != axis)
+    face = axis * 2 + (major < 0)
+
+    column = min(grid_size - 1, int(floor((u + 1) / 2 * grid_size)))
+    row = min(grid_size - 1, int(floor((v + 1) / 2 * grid_size)))
+    return (face * grid_size + row) * grid_size + column
+
+class NormalEncoder:
+    """Nearest entry of a normal table in constant time
+
+    Directions are bucketed on a grid over the faces of a cube. Each cell
+    lists every entry that can be the nearest one to a direction inside it,
+    so a lookup only compares against a few candidates.
+    """
+
+    def __init__(self, table):
+        self.table = [normalized(normal) for normal in table]
+        self.cells = []
+
+        step = 2 / grid_size
+
+        for face in range(6):
+            for row in range(grid_size):
+                for column in range(grid_size):
+                    u = -1 + column * step
+                    v = -1 + row * step
+                    center = face_direction(face, u + step / 2, v + step / 2)
+
+                    # The nearest entry to any point of the cell is at most the
+                    # cell radius further away than the one nearest the center
+                    radius = max(angle(center, face_direction(face, u + du, v + dv))
+                                 for du in (0, step) for dv in (0, step))
+                    distances = [angle(center, normal) for normal in self.table]
+                    limit = min(distances) + 2 * radius
+
+                    self.cells.append([index for index, distance in enumerate(distances)
+                                       if distance <= limit])
+
+    def encode(self, normal):
+        if not any(normal):
+            return 0
+
+        candidates = self.cells[grid_cell(normal)]
+        return max(candidates, key=lambda index: dot(self.table[index], normal))
+
+    def decode(self, index):
+        return self.table[index]
+
+    def encode_all(self, normals):
+        """Table indices of normals, with the mean and largest angle to them in degrees"""
+        indices = []
+        total_error = 0.0
+        max_error = 0.0
+
+        for normal in normals:
+            index = self.encode(normal)
+            indices.append(index)
+
+            if any(normal):
+                error = angle(self.table[index], normalized(normal))
+                total_error += error
+                max_error = max(max_error, error)
+
+        mean_error = total_error / len(normals) if normals else 0.0
+        return indices, degrees(mean_error), degrees(max_error)
@@ -0,0 +1,522 @@
+from math import floor, sqrt
+
+from .DtsTypes import Mesh, Primitive
+
+# Tolerances used when deciding whether two mesh corners are the same vertex
+weld_epsilon_co = 0.00001
+weld_epsilon_normal = 0.001
+weld_epsilon_uv = 0.00001
+
+neighbour_offsets = sorted(
+    ((dx, dy, dz) for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1)),
+    key=lambda offset: sum(map(abs, offset)))
+
+def close_enough(a, b, epsilon):
+    return all(abs(i - j) <= epsilon for i, j in zip(a, b))
+
+class VertexWelder:
+    """Find previously added vertices matching position, normal and UV"""
+
+    def __init__(self, epsilon_co=weld_epsilon_co,
+                 epsilon_normal=weld_epsilon_normal,
+                 epsilon_uv=weld_epsilon_uv):
+        self.epsilon_co = epsilon_co
+        self.epsilon_normal = epsilon_normal
+        self.epsilon_uv = epsilon_uv
+        self.cells = {}
+        self.welded = 0
+
+    def cell(self, co):
+        size = self.epsilon_co
+        return (
+            int(floor(co[0] / size)),
+            int(floor(co[1] / size)),
+            int(floor(co[2] / size)))
+
+    def find(self, co, normal, uv, source=None):
+        x, y, z = self.cell(co)
+
+        # Matches can sit on the other side of a cell boundary, so look at
+        # all 27 neighbouring cells (the own cell first, as it is the likeliest)
+        for dx, dy, dz in neighbour_offsets:
+            candidates = self.cells.get((x + dx, y + dy, z + dz))
+
+            if candidates is None:
+                continue
+
+            for index, other_co, other_normal, other_uv, other_source in candidates:
+                if other_source != source:
+                    continue
+
+                if close_enough(co, other_co, self.epsilon_co) and \
+                   close_enough(uv, other_uv, self.epsilon_uv) and \
+                   close_enough(normal, other_normal, self.epsilon_normal):
+                    self.welded += 1
+                    return index
+
+    def add(self, index, co, normal, uv, source=None):
+        entry = (index, tuple(co), tuple(normal), tuple(uv), source)
+        self.cells.setdefault(self.cell(co), []).append(entry)
+
+def third_vertex_map(triangles, skip):
+    # Map every directed edge to the triangles using it and their third vertex
+    edges = {}
+
+    for index, (a, b, c) in enumerate(triangles):
+        if index in skip:
+            continue
+
+        edges.setdefault((a, b), []).append((index, c))
+        edges.setdefault((b, c), []).append((index, a))
+        edges.setdefault((c, a), []).append((index, b))
+
+    return edges
+
+def grow_strip(triangles, edges, used, start, rotation):
+    a, b, c = triangles[start]
+    strip = [(a, b, c), (b, c, a), (c, a, b)][rotation]
+    strip = list(strip)
+    taken = [start]
+
+    while True:
+        u, v = strip[-2], strip[-1]
+
+        # Every other triangle in a strip has its winding flipped
+        if len(strip) % 2 == 0:
+            edge = (u, v)
+        else:
+            edge = (v, u)
+
+        for index, w in edges.get(edge, ()):
+            if index not in used and index not in taken:
+                break
+        else:
+            return strip, taken
+
+        strip.append(w)
+        taken.append(index)
+
+def join_strips(strips):
+    joined = []
+
+    for strip in strips:
+        if joined:
+            # Connect with degenerate triangles, keeping the winding parity
+            if len(joined) % 2 == 1:
+                joined.append(joined[-1])
+
+            joined.append(joined[-1])
+            joined.append(strip[0])
+
+        joined.extend(strip)
+
+    return joined
+
+def stripify(indices):
+    """Turn a triangle list into one strip joined by degenerate triangles"""
+    triangles = [tuple(indices[i:i + 3]) for i in range(0, len(indices) - 2, 3)]
+
+    # Degenerate triangles draw nothing, leave them out
+    used = set(index for index, (a, b, c) in enumerate(triangles)
+               if a == b or b == c or c == a)
+
+    edges = third_vertex_map(triangles, used)
+    strips = []
+
+    for start in range(len(triangles)):
+        if start in used:
+            continue
+
+        strip, taken = max(
+            (grow_strip(triangles, edges, used, start, rotation) for rotation in range(3)),
+            key=lambda result: len(result[1]))
+
+        used.update(taken)
+        strips.append(strip)
+
+    return join_strips(strips)
+
+# Tuning values for the vertex cache optimizer, from Tom Forsyth's
+# "Linear-Speed Vertex Cache Optimisation"
+cache_size = 32
+cache_decay_power = 1.5
+last_triangle_score = 0.75
+valence_boost_scale = 2.0
+valence_boost_power = 0.5
+
+def cache_misses(indices, fifo_size=16):
+    cache = []
+    misses = 0
+
+    for index in indices:
+        if index not in cache:
+            misses += 1
+            cache.append(index)
+
+            if len(cache) > fifo_size:
+                del cache[0]
+
+    return misses
+
+def average_cache_miss_ratio(indices, fifo_size=16):
+    if len(indices) < 3:
+        return 0.0
+
+    return cache_misses(indices, fifo_size) / (len(indices) // 3)
+
+def vertex_score(cache_position, remaining):
+    if remaining == 0:
+        return -1.0
+
+    if cache_position < 0:
+        score = 0.0
+    elif cache_position < 3:
+        # The vertices of the last triangle are deliberately penalized so
+        # the same triangle fan is not favored forever
+        score = last_triangle_score
+    else:
+        scale = 1.0 / (cache_size - 3)
+        score = (1.0 - (cache_position - 3) * scale) ** cache_decay_power
+
+    # Boost vertices with few triangles left so they get finished off
+    return score + valence_boost_scale * remaining ** -valence_boost_power
+
+def optimize_vertex_cache(indices):
+    """Reorder a triangle list for the post-transform vertex cache"""
+    triangles = [tuple(indices[i:i + 3]) for i in range(0, len(indices) - 2, 3)]
+
+    vertex_triangles = {}
+
+    for index, triangle in enumerate(triangles):
+        for vertex in triangle:
+            vertex_triangles.setdefault(vertex, []).append(index)
+
+    scores = {vertex: vertex_score(-1, len(tris)) for vertex, tris in vertex_triangles.items()}
+    triangle_scores = [sum(scores[vertex] for vertex in triangle) for triangle in triangles]
+    emitted = [False] * len(triangles)
+
+    cache = []
+    output = []
+    best = None
+    next_unemitted = 0
+
+    for _ in range(len(triangles)):
+        if best is None:
+            # Nothing useful in the cache, continue with the next unused triangle
+            while emitted[next_unemitted]:
+                next_unemitted += 1
+
+            best = next_unemitted
+
+        emitted[best] = True
+        triangle = triangles[best]
+        output.extend(triangle)
+
+        for vertex in triangle:
+            vertex_triangles[vertex].remove(best)
+
+            if vertex in cache:
+                cache.remove(vertex)
+
+        cache = list(triangle) + cache
+        evicted = cache[cache_size:]
+        del cache[cache_size:]
+
+        for vertex in evicted:
+            scores[vertex] = vertex_score(-1, len(vertex_triangles[vertex]))
+
+        for position, vertex in enumerate(cache):
+            scores[vertex] = vertex_score(position, len(vertex_triangles[vertex]))
+
+        # Only triangles touching the cache can have changed their score
+        best = None
+        best_score = -1.0
+
+        for vertex in cache + evicted:
+            for index in vertex_triangles[vertex]:
+                score = sum(scores[other] for other in triangles[index])
+                triangle_scores[index] = score
+
+                if score > best_score:
+                    best = index
+                    best_score = score
+
+    return output
+
+def reorder_vertices(mesh):
+    """Renumber the vertices of a DTS mesh in order of first use"""
+    remap = {}
+
+    for index in mesh.indices:
+        if index not in remap:
+            remap[index] = len(remap)
+
+    # Unreferenced vertices go at the end
+    for index in range(len(mesh.verts)):
+        if index not in remap:
+            remap[index] = len(remap)
+
+    order = sorted(remap, key=remap.get)
+
+    mesh.verts = [mesh.verts[index] for index in order]
+    mesh.normals = [mesh.normals[index] for index in order]
+    mesh.enormals = [mesh.enormals[index] for index in order]
+    mesh.tverts = [mesh.tverts[index] for index in order]
+    mesh.indices = [remap[index] for index in mesh.indices]
+    mesh.influences = [(remap[vertex], bone, weight)
+                       for vertex, bone, weight in mesh.influences]
+
+def mesh_triangles(mesh):
+    # Only meaningful for triangle list primitives
+    for prim in mesh.primitives:
+        for i in range(prim.firstElement, prim.firstElement + prim.numElements - 2, 3):
+            yield prim.type, tuple(mesh.indices[i:i + 3])
+
+def chunk_fits(mesh, triangles, max_vertices, max_elements):
+    vertices = set()
+
+    for _, _, triangle in triangles:
+        vertices.update(triangle)
+
+    # Primitive offsets are 16-bit too, so all elements together have to fit
+    return len(vertices) <= max_vertices and 3 * len(triangles) <= max_elements
+
+def split_triangles(mesh, triangles):
+    # Cut through the median triangle along the longest axis
+    centroids = {}
+
+    for entry in triangles:
+        points = [mesh.verts[index] for index in entry[2]]
+        centroids[entry[0]] = tuple(sum(p[axis] for p in points) / 3 for axis in range(3))
+
+    extent = [max(c[axis] for c in centroids.values()) - min(c[axis] for c in centroids.values())
+              for axis in range(3)]
+    axis = extent.index(max(extent))
+
+    triangles = sorted(triangles, key=lambda entry: centroids[entry[0]][axis])
+    middle = len(triangles) // 2
+    return triangles[:middle], triangles[middle:]
+
+def build_chunk(mesh, triangles):
+    chunk = Mesh(mesh.type)
+    chunk.bones = list(mesh.bones)
+
+    remap = {}
+    primitives = []
+
+    # Restore the original order so primitives stay grouped by material
+    for _, flags, triangle in sorted(triangles, key=lambda entry: entry[0]):
+        if not primitives or primitives[-1].type != flags:
+            primitives.append(Primitive(len(chunk.indices), 0, flags))
+
+        for index in triangle:
+            if index not in remap:
+                remap[index] = len(chunk.verts)
+                chunk.verts.append(mesh.verts[index])
+                chunk.normals.append(mesh.normals[index])
+                chunk.enormals.append(mesh.enormals[index])
+                chunk.tverts.append(mesh.tverts[index])
+
+            chunk.indices.append(remap[index])
+
+        primitives[-1].numElements += 3
+
+    chunk.primitives = primitives
+    chunk.influences = [(remap[vertex], bone, weight)
+                        for vertex, bone, weight in mesh.influences
+                        if vertex in remap]
+    chunk.vertsPerFrame = len(chunk.verts)
+
+    return chunk
+
+def split_mesh(mesh, max_vertices=65536, max_elements=65535):
+    """Partition a triangle list mesh spatially into meshes within the limits"""
+    triangles = [(order, flags, triangle) for order, (flags, triangle)
+                 in enumerate(mesh_triangles(mesh))]
+
+    if chunk_fits(mesh, triangles, max_vertices, max_elements):
+        return [mesh]
+
+    chunks = []
+    pending = [triangles]
+
+    while pending:
+        triangles = pending.pop()
+
+        if len(triangles) <= 1 or chunk_fits(mesh, triangles, max_vertices, max_elements):
+            chunks.append(triangles)
+        else:
+            first, second = split_triangles(mesh, triangles)
+            pending.append(second)
+            pending.append(first)
+
+    return [build_chunk(mesh, triangles) for triangles in chunks]
+
+def compact_bones(mesh):
+    # Drop the bones no influence of the mesh refers to
+    used = sorted(set(bone for _, bone, _ in mesh.influences))
+    remap = {bone: slot for slot, bone in enumerate(used)}
+
+    mesh.bones = [mesh.bones[bone] for bone in used]
+    mesh.influences = [(vertex, remap[bone], weight)
+                       for vertex, bone, weight in mesh.influences]
+
+def split_bone_palettes(mesh, palette_size):
+    """Partition a skin mesh into meshes that each use at most palette_size bones"""
+    if len(mesh.bones) <= palette_size:
+        return [mesh]
+
+    vertex_bones = {}
+
+    for vertex, bone, _ in mesh.influences:
+        vertex_bones.setdefault(vertex, set()).add(bone)
+
+    # Triangles using the same bones always end up in the same mesh
+    bone_sets = {}
+
+    for order, (flags, triangle) in enumerate(mesh_triangles(mesh)):
+        bones = frozenset().union(*(vertex_bones.get(index, ()) for index in triangle))
+        bone_sets.setdefault(bones, []).append((order, flags, triangle))
+
+    pending = sorted(bone_sets, key=lambda bones: (-len(bones), sorted(bones)))
+    chunks = []
+
+    while pending:
+        # Start with the largest bone set left, then keep adding the sets that
+        # need the fewest new bones, so few vertices are duplicated between meshes
+        bones = pending.pop(0)
+        palette = set(bones)
+        triangles = list(bone_sets[bones])
+
+        while pending:
+            best = None
+
+            for index, bones in enumerate(pending):
+                added = len(bones - palette)
+
+                if len(palette) + added > palette_size:
+                    continue
+
+                key = (added, -len(bones & palette), -len(bone_sets[bones]))
+
+                if best is None or key < best[0]:
+                    best = (key, index)
+
+            if best is None:
+                break
+
+            bones = pending.pop(best[1])
+            palette |= bones
+            triangles.extend(bone_sets[bones])
+
+        chunk = build_chunk(mesh, triangles)
+        compact_bones(chunk)
+        chunks.append(chunk)
+
+    return chunks
+
+# Neighbouring triangles join a cluster while their normals stay within
+# about 25 degrees of the triangle the cluster started from
+cluster_normal_threshold = 0.9
+
+def triangle_area_normal(a, b, c):
+    # Cross product of two edges, as long as twice the area of the triangle
+    u = (b[0] - a[0], b[1] - a[1], b[2] - a[2])
+    v = (c[0] - a[0], c[1] - a[1], c[2] - a[2])
+    return (u[1] * v[2] - u[2] * v[1], u[2] * v[0] - u[0] * v[2], u[0] * v[1] - u[1] * v[0])
+
+def normalized(v):
+    length = sqrt(v[0] * v[0] + v[1] * v[1] + v[2] * v[2])
+
+    if length == 0:
+        return (0.0, 0.0, 0.0)
+
+    return (v[0] / length, v[1] / length, v[2] / length)
+
+def cluster_triangles(verts, triangles):
+    """Group triangles into connected clusters facing roughly the same way"""
+    normals = [normalized(triangle_area_normal(*(verts[index] for index in triangle)))
+               for triangle in triangles]
+
+    # Connect triangles through edge positions, so UV and normal seams
+    # do not cut clusters apart
+    edge_triangles = {}
+
+    for t, triangle in enumerate(triangles):
+        for i in range(3):
+            a = tuple(verts[triangle[i]])
+            b = tuple(verts[triangle[(i + 1) % 3]])
+            edge_triangles.setdefault(frozenset((a, b)), []).append(t)
+
+    cluster_of = [None] * len(triangles)
+    clusters = []
+
+    for seed in range(len(triangles)):
+        if cluster_of[seed] is not None:
+            continue
+
+        cluster_of[seed] = len(clusters)
+        cluster = [seed]
+        stack = [seed]
+        seed_normal = normals[seed]
+
+        while stack:
+            triangle = triangles[stack.pop()]
+
+            for i in range(3):
+                a = tuple(verts[triangle[i]])
+                b = tuple(verts[triangle[(i + 1) % 3]])
+
+                for other in edge_triangles[frozenset((a, b))]:
+                    if cluster_of[other] is None and \
+                       sum(x * y for x, y in zip(normals[other], seed_normal)) >= cluster_normal_threshold:
+                        cluster_of[other] = len(clusters)
+                        cluster.append(other)
+                        stack.append(other)
+
+        clusters.append(cluster)
+
+    return clusters
+
+def sort_translucent(verts, indices, center):
+    """Order the triangles of a triangle list for drawing translucent surfaces
+
+    Without a depth sort at runtime, surfaces have to be drawn back to front
+    from wherever the shape is seen. Clusters that face in towards the center
+    are mostly covered by the rest of the mesh, so they go first and the
+    outward facing shell goes last. Returns the indices of each cluster in
+    drawing order.
+    """
+    triangles = [tuple(indices[i:i + 3]) for i in range(0, len(indices) - 2, 3)]
+    keyed = []
+
+    for cluster in cluster_triangles(verts, triangles):
+        area = 0.0
+        centroid = [0.0, 0.0, 0.0]
+        normal = [0.0, 0.0, 0.0]
+
+        for t in cluster:
+            points = [verts[index] for index in triangles[t]]
+            area_normal = triangle_area_normal(*points)
+            weight = sqrt(sum(x * x for x in area_normal))
+            area += weight
+
+            for axis in range(3):
+                centroid[axis] += weight * sum(p[axis] for p in points) / 3
+                normal[axis] += area_normal[axis]
+
+        if area > 0:
+            centroid = [c / area for c in centroid]
+        else:
+            centroid = [sum(verts[index][axis] for t in cluster for index in triangles[t]) /
+                        (3 * len(cluster)) for axis in range(3)]
+
+        # How far the cluster faces out from the center
+        normal = normalized(normal)
+        outwards = sum((centroid[axis] - center[axis]) * normal[axis] for axis in range(3))
+
+        keyed.append((outwards, len(keyed),
+                      [index for t in cluster for index in triangles[t]]))
+
+    keyed.sort()
+    return [cluster for _, _, cluster in keyed]
@@ -0,0 +1,60 @@
+from array import array
+
+# Translation (x, y, z), rotation (w, x, y, z) and scale (x, y, z)
+pose_width = 10
+
+class PoseStore:
+    """Sampled local transforms of nodes, stored as flat floats
+
+    The frames of each node are contiguous, so every track of a sequence
+    is read back as one slice.
+    """
+
+    def __init__(self, frames, nodes):
+        self.frames = list(frames)
+        self.frame_index = {frame: index for index, frame in enumerate(self.frames)}
+        self.node_index = {node: index for index, node in enumerate(nodes)}
+        self.values = array("d", bytes(8 * pose_width * len(self.frames) * len(self.node_index)))
+
+    def __contains__(self, node):
+        return node in self.node_index
+
+    def offset(self, node, frame):
+        return (self.node_index[node] * len(self.frames) + self.frame_index[frame]) * pose_width
+
+    def set(self, node, frame, translation, rotation, scale):
+        offset = self.offset(node, frame)
+        self.values[offset:offset + pose_width] = array(
+            "d", tuple(translation) + tuple(rotation) + tuple(scale))
+
+    def track(self, node, start, end):
+        """Translations, rotations and scales of a node from start to end as tuples"""
+        values = self.values[self.offset(node, start):self.offset(node, end) + pose_width]
+        offsets = range(0, len(values), pose_width)
+
+        return (
+            [tuple(values[i:i + 3]) for i in offsets],
+            [tuple(values[i + 3:i + 7]) for i in offsets],
+            [tuple(values[i + 7:i + 10]) for i in offsets])
+
+def quaternion_multiply(a, b):
+    aw, ax, ay, az = a
+    bw, bx, by, bz = b
+
+    return (
+        aw * bw - ax * bx - ay * by - az * bz,
+        aw * bx + ax * bw + ay * bz - az * by,
+        aw * by - ax * bz + ay * bw + az * bx,
+        aw * bz + ax * by - ay * bx + az * bw)
+
+def blend_track(translations, rotations, base_translation, base_rotation):
+    """Make a track relative to a base pose, as blend sequences store it"""
+    bx, by, bz = base_translation
+
+    # The inverse of a unit quaternion is its conjugate
+    qw, qx, qy, qz = base_rotation
+    inverse = (qw, -qx, -qy, -qz)
+
+    return (
+        [(x - bx, y - by, z - bz) for x, y, z in translations],
+        [quaternion_multiply(inverse, rotation) for rotation in rotations])
@@ -0,0 +1,55 @@
+import json
+from time import perf_counter
+
+class Stage:
+    def __init__(self, name, kind, parent):
+        self.name = name
+        self.kind = kind
+        self.parent = parent
+        self.counts = {}
+        self.start = perf_counter()
+        self.seconds = None
+
+    def finish(self, **counts):
+        self.seconds = perf_counter() - self.start
+        self.counts.update(counts)
+
+class StageProfiler:
+    """Records wall time and element counts of the stages of an export"""
+
+    def __init__(self):
+        self.stages = []
+
+    def begin(self, name, kind="stage", parent=None, **counts):
+        stage = Stage(name, kind, parent)
+        stage.counts.update(counts)
+        self.stages.append(stage)
+        return stage
+
+    def to_dict(self):
+        return {"stages": [{
+            "name": stage.name,
+            "kind": stage.kind,
+            "parent": stage.parent.name if stage.parent else None,
+            "seconds": stage.seconds,
+            "counts": stage.counts,
+        } for stage in self.stages]}
+
+    def write_json(self, filepath):
+        with open(filepath, "w") as fd:
+            json.dump(self.to_dict(), fd, indent=2)
+
+    def print_summary(self, limit=10):
+        finished = [stage for stage in self.stages if stage.seconds is not None]
+
+        for stage in finished:
+            if stage.parent is None:
+                print("  {:<24} {:8.3f}s".format(stage.name, stage.seconds))
+
+        # The slowest objects and sequences are usually what is worth looking at
+        details = sorted((stage for stage in finished if stage.parent is not None),
+                         key=lambda stage: stage.seconds, reverse=True)
+
+        for stage in details[:limit]:
+            print("  {:<24} {:8.3f}s  {} '{}'".format(
+                stage.parent.name, stage.seconds, stage.kind, stage.name))
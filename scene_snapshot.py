@@ -0,0 +1,84 @@
+import bpy
+from collections import namedtuple
+
+ObjectInfo = namedtuple("ObjectInfo", (
+    "ob",                # The Blender object itself, for data that changes over time
+    "name",
+    "type",
+    "parent",            # Parent object or None
+    "parent_type",
+    "parent_bone",
+    "children",          # Child objects, in Blender's order
+    "selected",
+    "custom_name",       # The "name" custom property, or None
+    "groups",            # Names of the groups the object is in
+    "node_index",        # The "nodeIndex" custom property, or None
+    "animated",          # Whether it has an action with any f-curves
+    "armature_modifier", # First armature modifier, or None
+    "has_transparency",  # Whether any material slot uses transparency
+))
+
+def object_info(ob, children=(), groups=()):
+    armature_modifier = None
+
+    for modifier in ob.modifiers:
+        if modifier.type == 'ARMATURE':
+            armature_modifier = modifier
+            break
+
+    data = ob.animation_data
+
+    return ObjectInfo(
+        ob=ob,
+        name=ob.name,
+        type=ob.type,
+        parent=ob.parent,
+        parent_type=ob.parent_type,
+        parent_bone=ob.parent_bone,
+        children=tuple(children),
+        selected=ob.select,
+        custom_name=ob.get("name"),
+        groups=tuple(groups),
+        node_index=ob.get("nodeIndex"),
+        animated=bool(data and data.action and len(data.action.fcurves)),
+        armature_modifier=armature_modifier,
+        has_transparency=any(slot.material and slot.material.use_transparency
+                             for slot in ob.material_slots))
+
+class SceneSnapshot:
+    """What the exporters need to know about every object, read in one pass"""
+
+    def __init__(self, scene):
+        # Object.children and Object.users_group each scan all of bpy.data,
+        # so both are worked out here in one pass instead
+        self.children = {}
+        self.groups = {}
+
+        for ob in bpy.data.objects:
+            if ob.parent is not None:
+                self.children.setdefault(ob.parent, []).append(ob)
+
+        for group in bpy.data.groups:
+            for ob in group.objects:
+                self.groups.setdefault(ob, []).append(group.name)
+
+        self.objects = tuple(map(self.object_info, scene.objects))
+        self.info = {info.ob: info for info in self.objects}
+
+    def object_info(self, ob):
+        return object_info(ob, self.children.get(ob, ()), self.groups.get(ob, ()))
+
+    def get(self, ob):
+        # Children and parents are not necessarily linked to the scene
+        info = self.info.get(ob)
+
+        if info is None:
+            info = self.info[ob] = self.object_info(ob)
+
+        return info
+
+    def of_type(self, type):
+        return [info for info in self.objects if info.type == type]
+
+    def roots(self):
+        return [info for info in self.objects if info.parent is None]
@@ -1,6 +1,9 @@
 from collections import OrderedDict
 import bpy
 
+from .util import can_sample_fcurves, sample_fcurves
+from .pose_store import PoseStore
+
 def find_seqs(scene, select_marker):
     sequences = OrderedDict()
     sequence_flags = {}
@@ -44,4 +47,84 @@ def find_seqs(scene, select_marker):
 
         sequences[name][what] = marker
 
-    return sequences, sequence_flags
\ No newline at end of file
+    return sequences, sequence_flags
+
+def check_seqs(sequences):
+    """Why the markers of the sequences cannot be exported, or None"""
+    for name, markers in sequences.items():
+        if "start" not in markers:
+            return "Missing start marker for sequence '{}'".format(name)
+
+        if "end" not in markers:
+            return "Missing end marker for sequence '{}'".format(name)
+
+        if markers["end"].frame < markers["start"].frame:
+            return "The end marker of sequence '{}' is before its start marker".format(name)
+
+def sample_poses(scene, nodes, sequences, fcurve_index):
+    """Sample the local transforms of (key, object) pairs at every sequence frame"""
+    # Every frame used by any sequence, so overlapping sequences share samples
+    frames = sorted(set(frame for markers in sequences.values()
+                        for frame in range(markers["start"].frame, markers["end"].frame + 1)))
+
+    # Store all animation data so we don't need to frame_set all over the place
+    animation_data = PoseStore(frames, (key for key, _ in nodes))
+
+    # Nodes only driven by their own f-curves are evaluated directly,
+    # the rest needs the whole scene to be evaluated at each frame
+    frame_set_nodes = []
+
+    for key, ob in nodes:
+        if not can_sample_fcurves(scene, ob):
+            frame_set_nodes.append((key, ob))
+            continue
+
+        for frame, sample in zip(frames, sample_fcurves(ob, frames, fcurve_index)):
+            animation_data.set(key, frame, *sample)
+
+    if frame_set_nodes:
+        print("Sampling {} nodes over {} frames".format(len(frame_set_nodes), len(frames)))
+
+        for frame in frames:
+            scene.frame_set(frame)
+
+            for key, ob in frame_set_nodes:
+                animation_data.set(key, frame, *ob.matrix_local.decompose())
+
+    return animation_data
+
+# How far a sampled track may stray from the default pose and still be dropped
+track_epsilon_translation = 0.00001
+track_epsilon_rotation = 0.000001
+track_epsilon_scale = 0.00001
+
+def vectors_match(values, default, epsilon):
+    return all(abs(value[i] - default[i]) <= epsilon
+               for value in values for i in range(3))
+
+def rotations_match(values, default, epsilon):
+    # q and -q describe the same rotation
+    return all(1.0 - abs(sum(a * b for a, b in zip(value, default))) <= epsilon
+               for value in values)
+
+def drop_constant_tracks(seq, index, translations, rotations, scales,
+                         default_translation, default_rotation, default_scale):
+    """Clear the matters flags of tracks that never leave the default pose"""
+    dropped = []
+
+    if seq.translationMatters[index] and vectors_match(
+            translations, default_translation, track_epsilon_translation):
+        seq.translationMatters[index] = False
+        dropped.append("translation")
+
+    if seq.rotationMatters[index] and rotations_match(
+            rotations, default_rotation, track_epsilon_rotation):
+        seq.rotationMatters[index] = False
+        dropped.append("rotation")
+
+    if seq.scaleMatters[index] and vectors_match(
+            scales, default_scale, track_epsilon_scale):
+        seq.scaleMatters[index] = False
+        dropped.append("scale")
+
+    return dropped
@@ -0,0 +1,254 @@
+from math import sqrt, ceil
+from heapq import heappush, heappop
+
+# Edges along mesh borders, UV seams, hard edges and material borders are
+# held in place by extra planes, weighted by this factor
+feature_weight = 1000.0
+
+def sub(a, b):
+    return (a[0] - b[0], a[1] - b[1], a[2] - b[2])
+
+def cross(a, b):
+    return (
+        a[1] * b[2] - a[2] * b[1],
+        a[2] * b[0] - a[0] * b[2],
+        a[0] * b[1] - a[1] * b[0])
+
+def dot(a, b):
+    return a[0] * b[0] + a[1] * b[1] + a[2] * b[2]
+
+def plane_quadric(normal, point, weight):
+    a, b, c = normal
+    d = -dot(normal, point)
+
+    return [weight * value for value in (
+        a * a, a * b, a * c, a * d,
+        b * b, b * c, b * d,
+        c * c, c * d,
+        d * d)]
+
+def add_quadric(q, r):
+    for i in range(10):
+        q[i] += r[i]
+
+def quadric_error(q, p):
+    x, y, z = p
+    return q[0] * x * x + 2 * q[1] * x * y + 2 * q[2] * x * z + 2 * q[3] * x + \
+        q[4] * y * y + 2 * q[5] * y * z + 2 * q[6] * y + \
+        q[7] * z * z + 2 * q[8] * z + q[9]
+
+def face_normal(a, b, c):
+    return cross(sub(b, a), sub(c, a))
+
+class Simplifier:
+    """Quadric error edge collapse on the triangles of a MeshData snapshot
+
+    Vertices only ever collapse onto one of their neighbours, so every
+    remaining corner still refers to a real Blender vertex (and its weights).
+    """
+
+    def __init__(self, groups):
+        self.positions = {}
+        self.triangles = []
+        self.vertex_triangles = {}
+
+        for group_index, (flags, corners) in enumerate(groups):
+            for i in range(0, len(corners) - 2, 3):
+                triangle = corners[i:i + 3]
+                verts = [corner[3] for corner in triangle]
+
+                if len(set(verts)) < 3:
+                    continue
+
+                index = len(self.triangles)
+                attributes = [(corner[1], corner[2]) for corner in triangle]
+                self.triangles.append((group_index, verts, attributes))
+
+                for corner in triangle:
+                    self.positions[corner[3]] = tuple(corner[0])
+                    self.vertex_triangles.setdefault(corner[3], set()).add(index)
+
+        self.alive = len(self.triangles)
+        self.versions = dict.fromkeys(self.positions, 0)
+        self.quadrics = {vert: [0.0] * 10 for vert in self.positions}
+
+        self.add_face_quadrics()
+        self.add_feature_quadrics()
+
+    def add_face_quadrics(self):
+        for _, verts, _ in self.triangles:
+            a, b, c = (self.positions[vert] for vert in verts)
+            normal = face_normal(a, b, c)
+            length = sqrt(dot(normal, normal))
+
+            if length == 0:
+                continue
+
+            normal = tuple(n / length for n in normal)
+            quadric = plane_quadric(normal, a, length / 2)
+
+            for vert in verts:
+                add_quadric(self.quadrics[vert], quadric)
+
+    def add_feature_quadrics(self):
+        edges = {}
+
+        for index, (group_index, verts, attributes) in enumerate(self.triangles):
+            for i in range(3):
+                j = (i + 1) % 3
+                key = tuple(sorted((verts[i], verts[j])))
+                corner_data = {verts[i]: attributes[i], verts[j]: attributes[j]}
+                edges.setdefault(key, []).append(
+                    (index, (group_index, corner_data[key[0]], corner_data[key[1]])))
+
+        for (u, v), uses in edges.items():
+            if len(uses) == 2 and uses[0][1] == uses[1][1]:
+                continue
+
+            # Constrain the edge with a plane through it, perpendicular to its faces
+            a, b = self.positions[u], self.positions[v]
+            edge = sub(b, a)
+
+            for index, _ in uses:
+                normal = cross(edge, face_normal(*(self.positions[vert]
+                                                   for vert in self.triangles[index][1])))
+                length = sqrt(dot(normal, normal))
+
+                if length == 0:
+                    continue
+
+                normal = tuple(n / length for n in normal)
+                quadric = plane_quadric(normal, a, feature_weight * dot(edge, edge))
+
+                add_quadric(self.quadrics[u], quadric)
+                add_quadric(self.quadrics[v], quadric)
+
+    def neighbours(self, vert):
+        result = set()
+
+        for index in self.vertex_triangles[vert]:
+            result.update(self.triangles[index][1])
+
+        result.discard(vert)
+        return result
+
+    def push_edges(self, heap, vert):
+        for other in self.neighbours(vert):
+            self.push_edge(heap, vert, other)
+
+    def push_edge(self, heap, u, v):
+        quadric = [a + b for a, b in zip(self.quadrics[u], self.quadrics[v])]
+
+        # Collapse whichever endpoint costs less to remove
+        cost_uv = quadric_error(quadric, self.positions[v])
+        cost_vu = quadric_error(quadric, self.positions[u])
+
+        if cost_vu < cost_uv:
+            u, v, cost = v, u, cost_vu
+        else:
+            cost = cost_uv
+
+        heappush(heap, (cost, u, v, self.versions[u], self.versions[v]))
+
+    def flips(self, source, target):
+        target_co = self.positions[target]
+
+        for index in self.vertex_triangles[source]:
+            verts = self.triangles[index][1]
+
+            if target in verts:
+                continue
+
+            before = face_normal(*(self.positions[vert] for vert in verts))
+            after = face_normal(*(target_co if vert == source else self.positions[vert]
+                                  for vert in verts))
+
+            if dot(before, before) > 0 and dot(before, after) <= 0:
+                return True
+
+        return False
+
+    def corner_attributes(self, vert):
+        # The normal and UV of a vertex, if all of its corners agree on them
+        found = set()
+
+        for index in self.vertex_triangles[vert]:
+            _, verts, attributes = self.triangles[index]
+            found.add(attributes[verts.index(vert)])
+
+        if len(found) == 1:
+            return found.pop()
+
+    def collapse(self, source, target):
+        target_attributes = self.corner_attributes(target)
+
+        for index in self.vertex_triangles.pop(source):
+            group_index, verts, attributes = self.triangles[index]
+
+            if target in verts:
+                # The triangle along the collapsed edge disappears
+                for vert in verts:
+                    if vert != source:
+                        self.vertex_triangles[vert].discard(index)
+
+                self.triangles[index] = None
+                self.alive -= 1
+            else:
+                corner = verts.index(source)
+                verts[corner] = target
+                self.vertex_triangles[target].add(index)
+
+                # Along seams the corner keeps its own normal and UV
+                if target_attributes is not None:
+                    attributes[corner] = target_attributes
+
+        add_quadric(self.quadrics[target], self.quadrics[source])
+        self.versions[target] += 1
+        del self.versions[source]
+
+    def run(self, target_triangles):
+        heap = []
+
+        for vert in self.positions:
+            for other in self.neighbours(vert):
+                if vert < other:
+                    self.push_edge(heap, vert, other)
+
+        while heap and self.alive > target_triangles:
+            _, source, target, source_version, target_version = heappop(heap)
+
+            if self.versions.get(source) != source_version or \
+               self.versions.get(target) != target_version:
+                continue
+
+            if target not in self.neighbours(source) or self.flips(source, target):
+                continue
+
+            self.collapse(source, target)
+            self.push_edges(heap, target)
+
+    def groups(self, original_groups):
+        corners = [[] for _ in original_groups]
+
+        for triangle in self.triangles:
+            if triangle is None:
+                continue
+
+            group_index, verts, attributes = triangle
+
+            for vert, (normal, uv) in zip(verts, attributes):
+                corners[group_index].append((self.positions[vert], normal, uv, vert))
+
+        return [(flags, group_corners)
+                for (flags, _), group_corners in zip(original_groups, corners)
+                if group_corners]
+
+def simplify_groups(groups, target):
+    """Reduce the triangles of MeshData groups to a ratio (<= 1) or a triangle budget"""
+    simplifier = Simplifier(groups)
+
+    if target <= 1:
+        target = int(ceil(simplifier.alive * target))
+
+    simplifier.run(max(1, int(target)))
+    return simplifier.groups(groups)
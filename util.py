@@ -1,7 +1,9 @@
 import os
 import bpy
+from mathutils import Quaternion, Euler
 from colorsys import hsv_to_rgb
 from itertools import count
+from bisect import bisect_left
 from fractions import Fraction
 
 texture_extensions = ("png", "jpg")
@@ -32,25 +34,57 @@ for name, color in default_materials.items():
 for key, value in tuple(default_materials.items()):
     default_materials[key.lower()] = value
 
-def resolve_texture(filepath, name):
-    dirname = os.path.dirname(filepath)
+# Directory listings from earlier operations with the mtime they were read at
+directory_listings = {}
 
-    while True:
-        texbase = os.path.join(dirname, name)
+def list_directory(dirname):
+    try:
+        mtime = os.stat(dirname).st_mtime_ns
+    except OSError:
+        return frozenset()
 
-        for extension in texture_extensions:
-            texname = texbase + "." + extension
+    cached = directory_listings.get(dirname)
 
-            if os.path.isfile(texname):
-                return texname
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
 
-        if os.path.ismount(dirname):
-            break
+    # Names only, a stat per entry would cost more than it saves on network
+    # shares. Whether a matching name is a file is checked when resolving.
+    try:
+        files = frozenset(map(os.path.normcase, os.listdir(dirname)))
+    except OSError:
+        files = frozenset()
 
-        prevdir, dirname = dirname, os.path.dirname(dirname)
+    directory_listings[dirname] = (mtime, files)
+    return files
 
-        if prevdir == dirname:
-            break
+class TextureIndex:
+    """Answers texture lookups for a model from directory listings read once"""
+
+    def __init__(self, filepath):
+        self.directories = []
+        dirname = os.path.dirname(filepath)
+
+        # Textures may be in the model directory or any directory above it
+        while True:
+            self.directories.append((dirname, list_directory(dirname)))
+
+            if os.path.ismount(dirname):
+                break
+
+            prevdir, dirname = dirname, os.path.dirname(dirname)
+
+            if prevdir == dirname:
+                break
+
+    def resolve(self, name):
+        for dirname, files in self.directories:
+            for extension in texture_extensions:
+                if os.path.normcase(name + "." + extension) in files:
+                    path = os.path.join(dirname, name) + "." + extension
+
+                    if os.path.isfile(path):
+                        return path
 
 def fractions():
     yield 0
@@ -128,30 +162,135 @@ def ob_rotation_curves(ob):
 def evaluate_all(curves, frame):
     return tuple(map(lambda c: c.evaluate(frame), curves))
 
-def array_from_fcurves(curves, data_path, array_size):
-    found = False
-    array = [None] * array_size
+class FCurveIndex:
+    """Curves of every action by data path, with sorted keyframe times"""
 
-    for curve in curves:
-        if curve.data_path == data_path and curve.array_index != -1:
-            array[curve.array_index] = curve
-            found = True
+    def __init__(self):
+        self.actions = {}
+        self.times = {}
 
-    if found:
-        return tuple(array)
+    def action_curves(self, action):
+        paths = self.actions.get(action.name)
 
-def array_from_fcurves_rotation(curves, ob):
-    data_path, array_count = fcurves_path_from_rotation(ob)
-    return array_from_fcurves(curves, data_path, array_count)
+        if paths is None:
+            paths = self.actions[action.name] = {}
+
+            for curve in action.fcurves:
+                if curve.array_index == -1:
+                    continue
+
+                # Animation evaluation ignores muted curves as well
+                if curve.mute or (curve.group is not None and curve.group.mute):
+                    continue
 
-def fcurves_keyframe_in_range(curves, start, end):
-    for curve in curves:
-        for keyframe in curve.keyframe_points:
-            frame = keyframe.co[0]
-            if frame >= start and frame <= end:
+                paths.setdefault(curve.data_path, {})[curve.array_index] = curve
+
+                points = curve.keyframe_points
+                co = [0.0] * (len(points) * 2)
+                points.foreach_get("co", co)
+                self.times[(action.name, curve.data_path, curve.array_index)] = sorted(co[0::2])
+
+        return paths
+
+    def curves(self, action, data_path, array_size):
+        by_index = self.action_curves(action).get(data_path)
+
+        if by_index:
+            return tuple(by_index.get(index) for index in range(array_size))
+
+    def rotation_curves(self, action, ob):
+        data_path, array_count = fcurves_path_from_rotation(ob)
+        return self.curves(action, data_path, array_count)
+
+    def keyframe_in_range(self, action, curves, start, end):
+        for curve in curves:
+            if curve is None:
+                continue
+
+            times = self.times[(action.name, curve.data_path, curve.array_index)]
+            index = bisect_left(times, start)
+
+            if index < len(times) and times[index] <= end:
                 return True
 
-    return False
+        return False
+
+def is_identity(mat):
+    return all(abs(mat[i][j] - (i == j)) < 0.000001 for i in range(4) for j in range(4))
+
+def can_sample_fcurves(scene, ob):
+    """Whether the local transform of an object comes only from its action"""
+    if ob.constraints or not is_identity(ob.matrix_parent_inverse):
+        return False
+
+    if any(ob.delta_location) or any(ob.delta_scale[i] != 1 for i in range(3)):
+        return False
+
+    if ob.delta_rotation_quaternion != Quaternion() or any(ob.delta_rotation_euler):
+        return False
+
+    if scene.render.frame_map_old != scene.render.frame_map_new:
+        return False
+
+    data = ob.animation_data
+
+    if data is None:
+        return True
+
+    if data.drivers or data.nla_tracks:
+        return False
+
+    if getattr(data, "action_influence", 1.0) != 1.0 or \
+       getattr(data, "action_blend_type", "REPLACE") != "REPLACE":
+        return False
+
+    return True
+
+def evaluate_channel(curves, values, frame):
+    if not curves:
+        return values
+
+    return tuple(curve.evaluate(frame) if curve else value
+                 for curve, value in zip(curves, values))
+
+def sample_fcurves(ob, frames, fcurve_index):
+    """Evaluate the decomposed local transform of an object at every frame"""
+    if ob.animation_data and ob.animation_data.action:
+        action = ob.animation_data.action
+        curves = (
+            fcurve_index.curves(action, "location", 3),
+            fcurve_index.rotation_curves(action, ob),
+            fcurve_index.curves(action, "scale", 3))
+    else:
+        curves = (None, None, None)
+
+    # Properties without a curve keep their current value
+    values = (tuple(ob.location), tuple(ob_rotation_data(ob)), tuple(ob.scale))
+    channels = tuple(zip(curves, values))
+
+    samples = []
+
+    for frame in frames:
+        location, rotation, scale = (evaluate_channel(curves, values, frame)
+                                     for curves, values in channels)
+
+        if ob.rotation_mode == 'QUATERNION':
+            mat = Quaternion(rotation).normalized().to_matrix()
+        elif ob.rotation_mode == 'AXIS_ANGLE':
+            mat = Quaternion(rotation[1:], rotation[0]).to_matrix()
+        else:
+            mat = Euler(rotation, ob.rotation_mode).to_matrix()
+
+        for i in range(3):
+            for j in range(3):
+                mat[i][j] *= scale[j]
+
+        mat = mat.to_4x4()
+        mat.translation = location
+
+        samples.append(mat.decompose())
+
+    return samples
 
 def find_reference(scene):
     reference_marker = scene.timeline_markers.get("reference")
@@ -0,0 +1,38 @@
+import zlib
+from struct import pack
+
+png_signature = b"\x89PNG\r\n\x1a\n"
+
+def png_chunk(kind, data):
+    return pack(">I", len(data)) + kind + data + \
+        pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+def encode_solid_png(width, height, color):
+    """Encode an 8-bit RGBA PNG filled with one color given as floats in 0..1"""
+    pixel = bytes(int(round(max(0.0, min(1.0, c)) * 255)) for c in color)
+
+    # Every scanline starts with its filter type, 0 (none)
+    row = b"\x00" + pixel * width
+    header = pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)
+
+    return png_signature + \
+        png_chunk(b"IHDR", header) + \
+        png_chunk(b"IDAT", zlib.compress(row * height, 9)) + \
+        png_chunk(b"IEND", b"")
+
+def write_if_changed(filepath, data):
+    """Write data to filepath unless the file already has exactly that content"""
+    try:
+        with open(filepath, "rb") as fd:
+            if fd.read() == data:
+                return False
+    except OSError:
+        pass
+
+    with open(filepath, "wb") as fd:
+        fd.write(data)
+
+    return True
+
+def write_solid_png(filepath, color, size=16):
+    return write_if_changed(filepath, encode_solid_png(size, size, color))
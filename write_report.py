@@ -119,10 +119,13 @@ def write_debug_report(filepath, shape):
             p("    bounds = " + str(mesh.bounds))
             p("    center = " + str(mesh.center))
             p("    radius = " + str(mesh.radius))
+            if hasattr(mesh, "acmr"):
+                p("    ACMR = {:.3f} (was {:.3f})".format(mesh.acmr[1], mesh.acmr[0]))
             # p("    numFrames = " + str(mesh.numFrames))
             # p("    numMatFrames = " + str(mesh.numMatFrames))
             # p("    vertsPerFrame = " + str(mesh.vertsPerFrame))
-            # p("    parent (unused?) = " + str(mesh.parent))
+            if mesh.parent >= 0:
+                p("    parent = " + str(mesh.parent))
             # p("    indices = " + ",".join(map(str, mesh.indices)))
             # p("    mindices = " + ",".join(map(str, mesh.mindices)))
             p("    + Primitives (" + str(len(mesh.primitives)) + "):")